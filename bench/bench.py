@@ -0,0 +1,176 @@
+'''Benchmarks for the DNSimple client, run against a local stand-in server.
+
+Each scenario is run in its own process, so that its peak memory can be
+measured, against a fresh fakeserver in another process. For example:
+
+    python bench/bench.py --scenarios get_record,create_record \
+                          --concurrency 1,8 --zone-sizes 100,10000
+'''
+
+import os
+import sys
+import time
+import base64
+import random
+import resource
+import argparse
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dnsimple import DNSimple, Transport
+import fakeserver
+
+DOMAIN = 'example0.com'
+
+def get_record(client, record_ids):
+    client.get_record(DOMAIN)
+
+def create_record(client, record_ids):
+    client.create_record(DOMAIN, 'bench%d' % random.randint(0, 1 << 30),
+                         'A', '10.0.0.2')
+
+def update_record(client, record_ids):
+    client.update_record(DOMAIN, random.choice(record_ids),
+                         record_content='10.0.0.%d' % random.randint(1, 254))
+
+SCENARIOS = {'get_record': get_record,
+             'create_record': create_record,
+             'update_record': update_record}
+
+class TenantCheck(object):
+    '''Wraps a shared Transport for one tenant's client, counting responses
+    that answer a request made with anyone else's credentials.'''
+    def __init__(self, transport, uname, pwd):
+        self.transport = transport
+        self.expected = 'Basic ' + base64.b64encode('%s:%s' % (uname, pwd))
+        self.mixed = 0
+
+    def request(self, method, url, auth, headers, **kwargs):
+        response = self.transport.request(method, url, auth, headers,
+                                          **kwargs)
+        if (response.headers.get('X-Echo-Authorization') != self.expected):
+            self.mixed += 1
+        return response
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def run_server(options, queue):
+    api = fakeserver.FakeDNSimple(zone_size=options.zone_size,
+                                  content_size=options.content_size,
+                                  latency=options.latency,
+                                  jitter=options.jitter,
+                                  error_rate=options.error_rate)
+    server = fakeserver.serve(api)
+    queue.put(server.server_address[1])
+    while True:
+        time.sleep(3600)
+
+def run_scenario(url, options, scenario, concurrency, queue):
+    # Every tenant's client shares one transport, as a multi-tenant worker
+    # would. Each checks that only its own credentials come back.
+    transport = Transport(pool_size=concurrency)
+    checks = [TenantCheck(transport, 'bench%d' % tenant, 'pw%d' % tenant)
+              for tenant in range(options.tenants)]
+    clients = [DNSimple('bench%d' % tenant, 'pw%d' % tenant, endpoint=url,
+                        retries=options.retries, transport=check)
+               for tenant, check in enumerate(checks)]
+    record_ids = [str(item["record"]["id"])
+                  for item in clients[0].iter_records(DOMAIN)]
+    operation = SCENARIOS[scenario]
+    latencies = []
+    errors = [0]
+
+    def timed(number):
+        started = time.time()
+        try:
+            operation(clients[number % len(clients)], record_ids)
+        except Exception:
+            errors[0] += 1
+        latencies.append(time.time() - started)
+
+    pool = ThreadPool(concurrency)
+    started = time.time()
+    pool.map(timed, range(options.requests), chunksize=1)
+    elapsed = time.time() - started
+    pool.close()
+
+    queue.put({"rate": options.requests / elapsed,
+               "p50": percentile(latencies, 0.5),
+               "p99": percentile(latencies, 0.99),
+               "errors": errors[0],
+               "mixed": sum(check.mixed for check in checks),
+               "peak_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+def in_process(target, *args):
+    '''Run target(*args, queue) in a new process, returning the first thing
+    it puts on the queue, and the process.'''
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=target, args=args + (queue,))
+    process.daemon = True
+    process.start()
+    return queue.get(), process
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default=','.join(sorted(SCENARIOS)),
+                        help='comma separated, from %s' %
+                             ', '.join(sorted(SCENARIOS)))
+    parser.add_argument('--concurrency', default='1,4,16',
+                        help='comma separated numbers of threads')
+    parser.add_argument('--zone-sizes', default='100,1000,10000',
+                        help='comma separated numbers of records')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per scenario')
+    parser.add_argument('--content-size', type=int, default=16,
+                        help='bytes of content in each record')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the server waits before responding')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='extra random wait of up to this many seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests that fail with a 500')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='retries the client makes')
+    parser.add_argument('--tenants', type=int, default=1,
+                        help='clients, each with its own credentials, '
+                             'sharing one transport')
+    options = parser.parse_args()
+
+    print '%-14s %6s %11s %10s %9s %9s %7s %6s %9s' % (
+        'scenario', 'zone', 'concurrency', 'req/s', 'p50 ms', 'p99 ms',
+        'errors', 'mixed', 'peak MB')
+
+    mixed = 0
+    for zone_size in [int(size) for size in options.zone_sizes.split(',')]:
+        options.zone_size = zone_size
+
+        for scenario in options.scenarios.split(','):
+            for concurrency in [int(n) for n in
+                                options.concurrency.split(',')]:
+                # A fresh server each time, so earlier scenarios creating
+                # records don't change the zone size.
+                port, server = in_process(run_server, options)
+                url = 'http://127.0.0.1:%d' % port
+                result, process = in_process(run_scenario, url, options,
+                                             scenario, concurrency)
+                process.join()
+                server.terminate()
+
+                print '%-14s %6d %11d %10.1f %9.1f %9.1f %7d %6d %9.1f' % (
+                    scenario, zone_size, concurrency, result["rate"],
+                    result["p50"] * 1000, result["p99"] * 1000,
+                    result["errors"], result["mixed"],
+                    result["peak_kb"] / 1024.0)
+                mixed += result["mixed"]
+
+    if mixed:
+        sys.exit('%d responses were for another tenant.' % mixed)
+
+if __name__ == '__main__':
+    main()
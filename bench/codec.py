@@ -0,0 +1,67 @@
+'''Micro-benchmark of parsing large get_record responses with each JSON
+library installed.
+
+    python bench/codec.py --records 10000
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dnsimple
+
+def payload(records):
+    '''A get_record response body for a zone of the given size, as bytes.'''
+    return json.dumps([{"record": {"id": number,
+                                   "domain_id": 1,
+                                   "name": "host%d" % number,
+                                   "record_type": "A",
+                                   "content": "10.0.%d.%d" % (number // 256,
+                                                              number % 256),
+                                   "ttl": 3600,
+                                   "prio": None,
+                                   "created_at": "2012-01-01T00:00:00Z",
+                                   "updated_at": "2012-01-01T00:00:00Z"}}
+                       for number in range(records)])
+
+def codecs():
+    '''Yield (name, loads) for every way of parsing we can compare.'''
+    # The way the client used to parse: decode to unicode, then parse.
+    yield 'json (decoded text)', lambda body: json.loads(body.decode('utf-8'))
+    yield 'json (bytes)', json.loads
+    for name in ('simplejson', 'ujson'):
+        try:
+            module = __import__(name)
+        except ImportError:
+            continue
+        yield name + ' (bytes)', module.loads
+    yield 'dnsimple default', dnsimple._json_loads
+
+def best_of(repeat, func, *args):
+    times = []
+    for _ in range(repeat):
+        started = time.time()
+        func(*args)
+        times.append(time.time() - started)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    options = parser.parse_args()
+
+    body = payload(options.records)
+    print '%d records, %.1f MB' % (options.records, len(body) / 1e6)
+    print '%-22s %9s %9s' % ('codec', 'ms', 'MB/s')
+    for name, loads in codecs():
+        seconds = best_of(options.repeat, loads, body)
+        print '%-22s %9.1f %9.1f' % (name, seconds * 1000,
+                                     len(body) / 1e6 / seconds)
+
+if __name__ == '__main__':
+    main()
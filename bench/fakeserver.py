@@ -0,0 +1,263 @@
+'''A local stand-in for the DNSimple REST API, for benchmarking the client
+without touching the real service.
+
+Implements enough of /domains, /domains/{domain}/records, /templates and
+/contacts for the client to work against it, keeping everything in memory.
+Latency, payload size and error rate can all be configured.
+
+Run it on its own with:
+
+    python bench/fakeserver.py --port 8080 --zone-size 1000
+'''
+
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+class FakeDNSimple(object):
+    '''The state of the stand-in API.
+
+    domains is the number of domains in the account, and zone_size the number
+    of records in each. Every record's content is padded to content_size
+    bytes. Each request waits latency seconds, plus up to jitter seconds, and
+    fails with a 500 with probability error_rate.'''
+    def __init__(self, domains=1, zone_size=100, content_size=16,
+                 latency=0.0, jitter=0.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.content_size = content_size
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.domains = {}
+        self.records = {}
+        self.templates = {}
+        self.contacts = {}
+
+        for index in range(domains):
+            name = 'example%d.com' % index
+            self.domains[name] = {"id": self.new_id(), "name": name,
+                                  "registrant_id": 1, "user_id": 1}
+            self.records[name] = {}
+            for number in range(zone_size):
+                self.add_record(name, {"name": "host%d" % number,
+                                       "record_type": "A",
+                                       "content": self.pad("10.0.0.1")})
+
+    def new_id(self):
+        with self.lock:
+            new_id = self.next_id
+            self.next_id += 1
+            return new_id
+
+    def pad(self, content):
+        return content + ' ' * max(0, self.content_size - len(content))
+
+    def add_record(self, domain, fields):
+        record = {"ttl": 3600, "prio": None}
+        record.update(fields)
+        record["id"] = self.new_id()
+        record["domain_id"] = self.domains[domain]["id"]
+        record["created_at"] = record["updated_at"] = "2012-01-01T00:00:00Z"
+        self.records[domain][record["id"]] = record
+        return record
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Otherwise the headers and body go out in separate packets, and delayed
+    # ACKs add 40ms to every request.
+    disable_nagle_algorithm = True
+
+    # (method, regex, handler name). The first match wins.
+    routes = [('GET',    r'/domains/?$',                   'list_domains'),
+              ('POST',   r'/domains/?$',                   'create_domain'),
+              ('GET',    r'/domains/([^/]+)/check$',       'check_domain'),
+              ('GET',    r'/domains/([^/]+)/records/?$',   'list_records'),
+              ('POST',   r'/domains/([^/]+)/records/?$',   'create_record'),
+              ('GET',    r'/domains/([^/]+)/records/(\d+)$', 'get_record'),
+              ('PUT',    r'/domains/([^/]+)/records/(\d+)$', 'update_record'),
+              ('DELETE', r'/domains/([^/]+)/records/(\d+)$', 'delete_record'),
+              ('GET',    r'/domains/([^/]+)$',             'get_domain'),
+              ('DELETE', r'/domains/([^/]+)$',             'delete_domain'),
+              ('GET',    r'/templates/?$',                 'list_templates'),
+              ('POST',   r'/templates/?$',                 'create_template'),
+              ('GET',    r'/contacts/?$',                  'list_contacts'),
+              ('POST',   r'/contacts/?$',                  'create_contact')]
+
+    def log_message(self, format, *args):
+        pass
+
+    def dispatch(self):
+        api = self.server.api
+        path = self.path.partition('?')[0]
+        delay = api.latency + random.uniform(0, api.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if (random.random() < api.error_rate):
+            return self.reply(500, {"error": "Injected failure"})
+
+        for method, pattern, name in self.routes:
+            match = re.match(pattern, path)
+            if ((method == self.command) and match):
+                return getattr(self, name)(api, *match.groups())
+        self.reply(404, {"error": "Not found"})
+
+    do_GET = do_POST = do_PUT = do_DELETE = dispatch
+
+    def body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def reply(self, status, payload):
+        body = json.dumps(payload)
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if ((self.command == 'GET') and
+                                (self.headers.get('If-None-Match') == etag)):
+            status, body = 304, ''
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        # So clients sharing connections can check they each got an answer
+        # to their own request.
+        self.send_header('X-Echo-Authorization',
+                         self.headers.get('Authorization', ''))
+        if (self.command == 'GET'):
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def domain(self, api, domain):
+        if domain in api.domains:
+            return domain
+        for name, fields in api.domains.items():
+            if (str(fields["id"]) == domain):
+                return name
+        return None
+
+    def list_domains(self, api):
+        self.reply(200, [{"domain": fields}
+                         for _, fields in sorted(api.domains.items())])
+
+    def create_domain(self, api):
+        name = self.body()["domain"]["name"]
+        api.domains[name] = {"id": api.new_id(), "name": name}
+        api.records[name] = {}
+        self.reply(201, {"domain": api.domains[name]})
+
+    def get_domain(self, api, domain):
+        domain = self.domain(api, domain)
+        if domain is None:
+            return self.reply(404, {"error": "Domain not found"})
+        self.reply(200, {"domain": api.domains[domain]})
+
+    def delete_domain(self, api, domain):
+        domain = self.domain(api, domain)
+        api.domains.pop(domain, None)
+        api.records.pop(domain, None)
+        self.reply(200, {})
+
+    def check_domain(self, api, domain):
+        if (self.domain(api, domain) is None):
+            return self.reply(404, {"name": domain, "status": "available"})
+        self.reply(200, {"name": domain, "status": "unavailable"})
+
+    def list_records(self, api, domain):
+        domain = self.domain(api, domain)
+        if domain is None:
+            return self.reply(404, {"error": "Domain not found"})
+        records = [{"record": record}
+                   for _, record in sorted(api.records[domain].items())]
+        self.reply(200, records)
+
+    def get_record(self, api, domain, record_id):
+        record = api.records.get(self.domain(api, domain), {}).get(
+                                                            int(record_id))
+        if record is None:
+            return self.reply(404, {"error": "Record not found"})
+        self.reply(200, {"record": record})
+
+    def create_record(self, api, domain):
+        domain = self.domain(api, domain)
+        if domain is None:
+            return self.reply(404, {"error": "Domain not found"})
+        fields = self.body()["record"]
+        fields["content"] = api.pad(fields["content"])
+        self.reply(201, {"record": api.add_record(domain, fields)})
+
+    def update_record(self, api, domain, record_id):
+        record = api.records.get(self.domain(api, domain), {}).get(
+                                                            int(record_id))
+        if record is None:
+            return self.reply(404, {"error": "Record not found"})
+        record.update(self.body()["record"])
+        self.reply(200, {"record": record})
+
+    def delete_record(self, api, domain, record_id):
+        api.records.get(self.domain(api, domain), {}).pop(int(record_id),
+                                                          None)
+        self.reply(200, {})
+
+    def list_templates(self, api):
+        self.reply(200, [{"dns_template": template}
+                         for _, template in sorted(api.templates.items())])
+
+    def create_template(self, api):
+        template = self.body()["dns_template"]
+        template["id"] = api.new_id()
+        api.templates[template["id"]] = template
+        self.reply(201, {"dns_template": template})
+
+    def list_contacts(self, api):
+        self.reply(200, [{"contact": contact}
+                         for _, contact in sorted(api.contacts.items())])
+
+    def create_contact(self, api):
+        contact = self.body()["contact"]
+        contact["id"] = api.new_id()
+        api.contacts[contact["id"]] = contact
+        self.reply(201, {"contact": contact})
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+def serve(api, port=0):
+    '''Start serving api on a background thread. Returns the server; its URL
+    is http://127.0.0.1:<server.server_address[1]>.'''
+    server = Server(('127.0.0.1', port), Handler)
+    server.api = api
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--domains', type=int, default=1)
+    parser.add_argument('--zone-size', type=int, default=100)
+    parser.add_argument('--content-size', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    api = FakeDNSimple(args.domains, args.zone_size, args.content_size,
+                       args.latency, args.jitter, args.error_rate)
+    server = Server(('127.0.0.1', args.port), Handler)
+    server.api = api
+    print 'Serving on http://127.0.0.1:%d' % server.server_address[1]
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+'''Measures how long a fresh process takes to import the client, make one,
+and get the answer to its first request, as a short-lived script would.
+
+    python bench/startup.py --runs 20
+'''
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fakeserver
+
+# Run in a new interpreter for each measurement, so nothing is imported yet.
+CHILD = '''
+import sys, time, json
+started = time.time()
+import dnsimple
+imported = time.time()
+client = dnsimple.DNSimple('bench', 'bench', endpoint=sys.argv[1])
+constructed = time.time()
+client.get_domain('example0.com')
+called = time.time()
+print json.dumps({"import": imported - started,
+                  "construct": constructed - imported,
+                  "first_call": called - constructed,
+                  "total": called - started})
+'''
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    options = parser.parse_args()
+
+    server = fakeserver.serve(fakeserver.FakeDNSimple(zone_size=1))
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+                       [root] + os.environ.get('PYTHONPATH', '').split(
+                                                            os.pathsep)))
+
+    runs = [json.loads(subprocess.check_output(
+                                    [sys.executable, '-c', CHILD, url],
+                                    env=env))
+            for _ in range(options.runs)]
+
+    print '%-12s %9s %9s' % ('phase', 'p50 ms', 'min ms')
+    for phase in ('import', 'construct', 'first_call', 'total'):
+        times = [run[phase] for run in runs]
+        print '%-12s %9.1f %9.1f' % (phase, median(times) * 1000,
+                                     min(times) * 1000)
+
+if __name__ == '__main__':
+    main()
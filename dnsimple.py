@@ -2,65 +2,1511 @@
 https://dnsimple.com/documentation/api
 '''
 
+import os
 import re
+import sys
 import json
-import requests
+import heapq
+import bisect
+import codecs
+import copy
+import hashlib
+import datetime
+import itertools
+import time
+import random
+import importlib
+import threading
+import Queue
+from collections import OrderedDict, Iterator
+from contextlib import closing
+
+class _LazyModule(object):
+    '''Stands in for a module, and only imports it when one of its
+    attributes is first used.
+
+    Importing requests in particular takes longer than everything else
+    here put together, which is a waste for scripts that never get as far as
+    making a request.'''
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self.__name)
+        # From now on attributes are found without coming through here.
+        self.__dict__.update(vars(module))
+        return getattr(module, attribute)
+
+requests = _LazyModule('requests')
+sqlite3 = _LazyModule('sqlite3')
+multiprocessing = _LazyModule('multiprocessing')
+
+def ThreadPool(processes=None):
+    '''A multiprocessing.pool.ThreadPool, imported when first needed.'''
+    from multiprocessing.pool import ThreadPool
+    return ThreadPool(processes)
+
+def _fastest_json_codec():
+    '''Find the fastest JSON library installed, falling back to the
+    standard library. Returns its (loads, dumps) functions.'''
+    for name in ('ujson', 'simplejson'):
+        try:
+            module = __import__(name)
+        except ImportError:
+            continue
+        return module.loads, module.dumps
+    return json.loads, json.dumps
+
+# Until first used, these find the codec and then replace themselves with
+# it, so that looking for one doesn't slow down importing this module.
+def _json_loads(data):
+    set_json_codec(*_fastest_json_codec())
+    return _json_loads(data)
+
+def _json_dumps(data):
+    set_json_codec(*_fastest_json_codec())
+    return _json_dumps(data)
+
+def set_json_codec(loads, dumps):
+    '''Use the given functions to parse and serialise JSON.
+
+    By default ujson or simplejson is used if installed, or the standard
+    library otherwise. loads must accept UTF-8 encoded bytes.'''
+    global _json_loads, _json_dumps
+    _json_loads, _json_dumps = loads, dumps
+
+def _run_concurrently(func, items, max_workers, key=None):
+    '''Call func on every item using at most max_workers threads.
+
+    Returns a list of (success, value) tuples in the same order as items.
+    If key is given, items with the same key are run one after another in
+    the order given, rather than concurrently.'''
+    items = list(items)
+    results = [None] * len(items)
+    groups = {}
+    order = []
+
+    for index, item in enumerate(items):
+        group = key(item) if key else index
+        if group not in groups:
+            groups[group] = []
+            order.append(group)
+        groups[group].append(index)
+
+    def run(group):
+        for index in groups[group]:
+            try:
+                results[index] = (True, func(items[index]))
+            except Exception, e:
+                results[index] = (False, e)
+
+    if not order:
+        return results
+
+    if (max_workers == 1):
+        for group in order:
+            run(group)
+        return results
+
+    pool = ThreadPool(min(max_workers, len(order)))
+    try:
+        pool.map(run, order)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+def _iter_concurrently(func, items, max_workers):
+    '''Call func on every item using at most max_workers threads, yielding
+    each result as soon as it is ready, in no particular order.
+
+    func should catch its own exceptions. If the caller stops iterating
+    early, items not yet started are never run.'''
+    items = list(items)
+    if not items:
+        return
+
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        for result in pool.imap_unordered(func, items):
+            yield result
+    finally:
+        pool.terminate()
+
+def _expect_record(result):
+    '''Check the response to creating or updating a record, which the API
+    reports errors in without a failing status, and return it.'''
+    if not (isinstance(result, dict) and ("record" in result)):
+        raise Exception('The record was not saved: %r' % (result,))
+    return result
+
+# Records DNSimple manages for you at the apex of a zone. These are only
+# deleted by a sync if the desired records say how the apex ones should look.
+SYSTEM_RECORD_TYPES = ("SOA", "NS")
+
+def _diff_records(existing, desired, delete=True):
+    '''Work out the changes needed to turn the existing records into the
+    desired ones.
+
+    Both must be lists of record dicts as found inside get_record results.
+    Returns a dict of "create", "update" and "delete" lists. If delete is
+    false, records that aren't desired are left alone.'''
+    def changes(old, new, fields):
+        update = {}
+        for field in fields:
+            if (new.get(field) not in (None, "") and
+                                    str(new[field]) != str(old.get(field))):
+                update[field] = new[field]
+        return update
+
+    exact = {}
+    for record in existing:
+        key = (record["name"], record["record_type"], record["content"])
+        exact.setdefault(key, []).append(record)
+
+    plan = {"create": [], "update": [], "delete": []}
+    unmatched = []
+
+    # Records that already exist only need their TTL or prio checking.
+    for record in desired:
+        key = (record["name"], record["record_type"], record["content"])
+        if exact.get(key):
+            old = exact[key].pop()
+            update = changes(old, record, ("ttl", "prio"))
+            if update:
+                update["id"] = old["id"]
+                plan["update"].append(update)
+        else:
+            unmatched.append(record)
+
+    leftover = {}
+    for records in exact.values():
+        for record in records:
+            key = (record["name"], record["record_type"])
+            leftover.setdefault(key, []).append(record)
+
+    # Anything else is better updated in place than deleted and recreated.
+    for record in unmatched:
+        key = (record["name"], record["record_type"])
+        if leftover.get(key):
+            old = leftover[key].pop()
+            update = changes(old, record, ("content", "ttl", "prio"))
+            update["id"] = old["id"]
+            plan["update"].append(update)
+        else:
+            plan["create"].append(record)
+
+    if delete:
+        # Delegating a subdomain with NS records says nothing about the
+        # apex NS records, so only records at the apex are protected.
+        desired_apex = set(record["record_type"] for record in desired
+                           if not record["name"])
+        for records in leftover.values():
+            for record in records:
+                if ((not record["name"]) and
+                        (record["record_type"] in SYSTEM_RECORD_TYPES) and
+                        (record["record_type"] not in desired_apex)):
+                    continue
+                plan["delete"].append(record["id"])
+
+    return plan
+
+# Number of bytes read from the network at a time when streaming a response.
+_STREAM_CHUNK_SIZE = 64 * 1024
+
+def _iter_json_array(chunks):
+    '''Parse a JSON array from an iterable of UTF-8 byte strings, yielding
+    each element as soon as it has been read.'''
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = u''
+    pos = 0
+    started = False
+
+    while True:
+        while ((pos < len(buf)) and (buf[pos] in u' \t\r\n,')):
+            pos += 1
+
+        if (pos < len(buf)):
+            if not started:
+                if (buf[pos] != u'['):
+                    raise ValueError('Response is not a JSON array.')
+                started = True
+                pos += 1
+                continue
+
+            if (buf[pos] == u']'):
+                return
+
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Most likely only part of the item has arrived so far.
+                pass
+            else:
+                # Only an item followed by a delimiter is known to be
+                # complete. A number like 3.5 may have arrived as far as 3.
+                if ((end < len(buf)) and (buf[end] in u' \t\r\n,]')):
+                    yield item
+                    pos = end
+                    continue
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError('Response ended before the JSON array did.')
+        buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+
+# Record types whose content is a host name, which zone files may give
+# relative to the origin, and those whose content is quoted text.
+_HOSTNAME_TYPES = ('CNAME', 'MX', 'NS', 'PTR', 'SRV', 'ALIAS')
+_TEXT_TYPES = ('TXT', 'SPF')
+_PRIO_TYPES = ('MX', 'SRV')
+
+_ZONE_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|;.*|[()]|[^\s"();]+')
+_TTL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+def _parse_ttl(token):
+    '''Parse a BIND TTL such as 3600 or 1h30m, or return None if token isn't
+    one.'''
+    if token.isdigit():
+        return int(token)
+    parts = re.findall(r'(\d+)([smhdw])', token.lower())
+    if (not parts) or (''.join(n + u for n, u in parts) != token.lower()):
+        return None
+    return sum(int(number) * _TTL_UNITS[unit] for number, unit in parts)
+
+def _iter_zone_entries(fileobj):
+    '''Split a zone file into entries, joining entries split over lines with
+    parentheses. Yields (has_owner, tokens) without the comments.'''
+    tokens = []
+    has_owner = False
+    depth = 0
+    for line in fileobj:
+        if not depth:
+            has_owner = bool(line[:1].strip())
+        for token in _ZONE_TOKEN.findall(line):
+            if token.startswith(';'):
+                break
+            elif (token == '('):
+                depth += 1
+            elif (token == ')'):
+                depth -= 1
+            else:
+                tokens.append(token)
+
+        if (not depth) and tokens:
+            yield has_owner, tokens
+            tokens = []
+
+    if tokens:
+        raise ValueError('Zone file ended inside parentheses.')
+
+def _iter_zone_records(fileobj, domain, default_ttl=None):
+    '''Parse a BIND zone file line by line, yielding each record as a dict in
+    the form accepted by create_records.
+
+    Names are made relative to domain, as DNSimple expects, and $ORIGIN and
+    $TTL are honoured.'''
+    domain = domain.rstrip('.').lower()
+    origin = domain + '.'
+    ttl = default_ttl
+    owner = origin
+
+    def absolute(name):
+        if (name == '@'):
+            return origin
+        if name.endswith('.'):
+            return name
+        return name + '.' + origin
+
+    for has_owner, tokens in _iter_zone_entries(fileobj):
+        if (tokens[0].upper() == '$ORIGIN'):
+            origin = absolute(tokens[1])
+            continue
+        if (tokens[0].upper() == '$TTL'):
+            ttl = _parse_ttl(tokens[1])
+            continue
+        if tokens[0].startswith('$'):
+            raise ValueError('Unsupported zone file directive: ' + tokens[0])
+
+        if has_owner:
+            owner = absolute(tokens.pop(0))
+
+        record_ttl = ttl
+        while (tokens and (tokens[0].upper() in ('IN', 'CH', 'HS') or
+                                       _parse_ttl(tokens[0]) is not None)):
+            token = tokens.pop(0)
+            if (token.upper() not in ('IN', 'CH', 'HS')):
+                record_ttl = _parse_ttl(token)
+
+        if (len(tokens) < 2):
+            raise ValueError('Incomplete zone file entry for ' + owner)
+
+        record_type = tokens[0].upper()
+        rdata = tokens[1:]
+
+        name = owner.rstrip('.').lower()
+        if (name == domain):
+            name = ''
+        elif name.endswith('.' + domain):
+            name = name[:-len(domain) - 1]
+        else:
+            raise ValueError(owner + ' is not in ' + domain)
+
+        record = {"name": name, "record_type": record_type}
+        if record_ttl is not None:
+            record["ttl"] = record_ttl
+        if (record_type in _PRIO_TYPES):
+            record["prio"] = int(rdata.pop(0))
+        if (record_type in _HOSTNAME_TYPES):
+            rdata[-1] = absolute(rdata[-1]).rstrip('.')
+        if (record_type in _TEXT_TYPES):
+            record["content"] = ''.join(
+                re.sub(r'\\(.)', r'\1', token[1:-1])
+                if token.startswith('"') else token
+                for token in rdata)
+        else:
+            record["content"] = ' '.join(rdata)
+
+        yield record
+
+def _zone_file_line(record, default_ttl):
+    '''Format a record dict from get_record as a line of a zone file.'''
+    content = record["content"]
+    if (record["record_type"] in _TEXT_TYPES):
+        content = '"%s"' % content.replace('\\', '\\\\').replace('"', '\\"')
+    elif (record["record_type"] in _HOSTNAME_TYPES):
+        content = content.rstrip('.') + '.'
+    elif (record["record_type"] == 'SOA'):
+        # The primary name server and the contact mailbox are names too.
+        fields = content.split()
+        fields[:2] = [field.rstrip('.') + '.' for field in fields[:2]]
+        content = ' '.join(fields)
+    if ((record["record_type"] in _PRIO_TYPES) and
+                                        (record.get("prio") is not None)):
+        content = '%s %s' % (record["prio"], content)
+
+    return '%-24s %7s IN %-6s %s\n' % (record["name"] or '@',
+                                       record.get("ttl") or default_ttl,
+                                       record["record_type"],
+                                       content)
+
+class _SingleFlight(object):
+    '''Runs at most one call per key at a time. Callers asking for a key that
+    is already being fetched wait for that call and get a copy of its
+    result, so that none of them can change another's, or its exception.'''
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__calls = {}
+
+    def do(self, key, func):
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.__calls[key] = {"done": threading.Event()}
+
+        if not leader:
+            call["done"].wait()
+            if ("error" in call):
+                raise call["error"][0], call["error"][1], call["error"][2]
+            return copy.deepcopy(call["result"])
+
+        try:
+            call["result"] = func()
+            return call["result"]
+        except:
+            call["error"] = sys.exc_info()
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call["done"].set()
+
+# Returned by cache lookups that find nothing, as None is a valid response.
+_MISSING = object()
+
+# Writes to these add or change domains without going through /domains.
+_DOMAIN_COLLECTIONS = ('domain_registrations',
+                       'domain_transfers',
+                       'domain_renewal')
+
+def _invalidation_scope(url):
+    '''Work out what a write to url may have changed. Returns the listing the
+    written object appears in, and the url of the object, everything below
+    which may also have changed.'''
+    segments = url.strip('/').split('/')
+    if (segments[0] in _DOMAIN_COLLECTIONS):
+        segments = ['domains']
+    listing = '/' + segments[0] + '/'
+    if len(segments) > 1:
+        return listing, listing + segments[1]
+    return listing, listing.rstrip('/')
+
+class ResponseCache(object):
+    '''An in-memory, thread-safe LRU cache of parsed GET responses.
+
+    maxsize is the most responses that will be kept.
+    ttl is the number of seconds a response is kept for, or None to keep it
+    until it is evicted.
+    ttls may be a list of (regex, ttl) pairs. The TTL of the first regex to
+    match the start of a URL, e.g. '/domains/[^/]+/records', is used instead
+    of the default for that URL. A TTL of 0 stops that URL being cached.
+
+    Responses are keyed by (namespace, method, url), where a client's
+    namespace is its account and endpoint, so one cache can be shared by
+    clients for different accounts without them seeing each other's data.
+
+    Cached responses are shared between callers, so don't modify them.'''
+    def __init__(self, maxsize=256, ttl=60, ttls=()):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.ttls = [(re.compile(pattern), seconds)
+                     for pattern, seconds in ttls]
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''Get the response for a (namespace, method, url) key, or default if
+        it isn't cached or has expired.'''
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return default
+
+            expires, value = entry
+            if (expires is not None and expires < time.time()):
+                # Leave it where it is for get_stale, until it is evicted.
+                return default
+
+            # Put it back at the most recently used end.
+            del self.__entries[key]
+            self.__entries[key] = entry
+            return value
+
+    def get_stale(self, key, default=None):
+        '''Get the response for a (namespace, method, url) key even if it has
+        expired, as long as it hasn't been evicted or invalidated.'''
+        with self.__lock:
+            entry = self.__entries.get(key)
+            return default if entry is None else entry[1]
+
+    def set(self, key, value):
+        '''Cache the response for a (namespace, method, url) key.'''
+        ttl = self.ttl
+        for pattern, seconds in self.ttls:
+            if pattern.match(key[-1]):
+                ttl = seconds
+                break
+
+        if (ttl == 0):
+            return
+
+        expires = None if ttl is None else time.time() + ttl
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = (expires, value)
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, url, namespace=None):
+        '''Forget everything a write to the given url may have changed.
+
+        That is the listing the written object appears in and everything
+        below the object, e.g. a write to /domains/example.com/records/1
+        forgets /domains/ and everything under /domains/example.com. A write
+        to a whole collection, e.g. /domains, forgets everything in that
+        collection. If namespace is given, only that namespace's responses
+        are forgotten.'''
+        listing, scope = _invalidation_scope(url)
+
+        def affected(cached_url):
+            # Pages of a listing are affected like the whole listing.
+            cached_url = cached_url.partition('?')[0]
+            return (cached_url == listing or cached_url == scope or
+                    cached_url.startswith(scope + '/'))
+
+        with self.__lock:
+            for key in list(self.__entries):
+                if (((namespace is None) or (key[0] == namespace)) and
+                                                        affected(key[-1])):
+                    del self.__entries[key]
+
+    def clear(self):
+        '''Forget every cached response.'''
+        with self.__lock:
+            self.__entries.clear()
+
+# Responses that rarely change, and so are worth keeping in a DiskCache.
+_PERSISTENT_URLS = re.compile(r'/(services|templates|extended_attributes)/')
+
+class DiskCache(object):
+    '''A cache of parsed GET responses kept in an SQLite database, so that it
+    outlives the process and can be shared by many processes at once.
+
+    path is the database file, which is created if needed.
+    ttl and ttls work as for ResponseCache, but default to a day.
+
+    Responses are kept per user and endpoint, so one file can be shared by
+    clients for different accounts.'''
+    def __init__(self, path, ttl=86400, ttls=()):
+        self.path = path
+        self.ttl = ttl
+        self.ttls = [(re.compile(pattern), seconds)
+                     for pattern, seconds in ttls]
+        with closing(self.__connect()) as db:
+            # Write-ahead logging lets readers carry on while one process
+            # writes.
+            db.execute("PRAGMA journal_mode=WAL")
+            with db:
+                db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                           " namespace TEXT NOT NULL,"
+                           " url TEXT NOT NULL,"
+                           " expires REAL,"
+                           " value TEXT NOT NULL,"
+                           " PRIMARY KEY (namespace, url))")
+
+    def __connect(self):
+        # A connection per call keeps this safe to use from any thread, and
+        # after forking.
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, namespace, url, default=None):
+        '''Get the response for url, or default if it isn't cached or has
+        expired.'''
+        with closing(self.__connect()) as db:
+            row = db.execute("SELECT value FROM responses"
+                             " WHERE namespace = ? AND url = ?"
+                             " AND (expires IS NULL OR expires >= ?)",
+                             (namespace, url, time.time())).fetchone()
+        if row is None:
+            return default
+        return _json_loads(row[0])
+
+    def set(self, namespace, url, value):
+        '''Cache the response for url.'''
+        ttl = self.ttl
+        for pattern, seconds in self.ttls:
+            if pattern.match(url):
+                ttl = seconds
+                break
+
+        if (ttl == 0):
+            return
+
+        now = time.time()
+        expires = None if ttl is None else now + ttl
+        with closing(self.__connect()) as db:
+            with db:
+                db.execute("DELETE FROM responses WHERE expires < ?", (now,))
+                db.execute("INSERT OR REPLACE INTO responses"
+                           " (namespace, url, expires, value)"
+                           " VALUES (?, ?, ?, ?)",
+                           (namespace, url, expires, _json_dumps(value)))
+
+    def invalidate(self, namespace, url):
+        '''Forget everything a write to the given url may have changed, as
+        for ResponseCache.invalidate.'''
+        listing, scope = _invalidation_scope(url)
+        def like(prefix):
+            return re.sub(r'([\\%_])', r'\\\1', prefix) + '%'
+
+        with closing(self.__connect()) as db:
+            with db:
+                db.execute("DELETE FROM responses WHERE namespace = ?"
+                           " AND (url = ? OR url = ?"
+                           "      OR url LIKE ? ESCAPE '\\'"
+                           "      OR url LIKE ? ESCAPE '\\'"
+                           "      OR url LIKE ? ESCAPE '\\')",
+                           (namespace, listing, scope, like(listing + '?'),
+                            like(scope + '?'), like(scope + '/')))
+
+    def clear(self):
+        '''Forget every cached response, for every namespace.'''
+        with closing(self.__connect()) as db:
+            with db:
+                db.execute("DELETE FROM responses")
+
+class Transport(object):
+    '''A pool of keep-alive connections to the API, which can be shared by
+    any number of clients, for any number of accounts, from any number of
+    threads.
+
+    Credentials are sent with each request rather than stored, and cookies
+    are never stored, so nothing leaks from one client to another.
+
+    pool_size is the number of connections kept open to each host. Up to
+    that many requests are sent at once; further connections are opened if
+    needed, but closed again after use.
+    keep_alive may be set false to close each connection after one request.
+    timeout is how long to wait, in seconds, to connect and for each read.
+    None waits forever.
+
+    HTTP/1.1 pipelining is not supported by requests, so each connection
+    carries one request at a time.'''
+    def __init__(self, pool_size=10, keep_alive=True, timeout=None):
+        self.timeout = timeout
+        self.__config = {"pool_connections": pool_size,
+                         "pool_maxsize": pool_size,
+                         "keep_alive": keep_alive,
+                         "store_cookies": False}
+        # The session is made on the first request, so that making a client
+        # to send one request costs no more than it has to.
+        self.__session = None
+        self.__lock = threading.Lock()
+
+    def __get_session(self):
+        if (self.__session is None):
+            with self.__lock:
+                if (self.__session is None):
+                    self.__session = requests.session(config=self.__config)
+        return self.__session
+
+    def request(self, method, url, auth, headers, **kwargs):
+        '''Send a request, and return the response.
+
+        method should be a string indicating the method, e.g. 'get'
+        auth should be a (username, password) tuple
+        headers should be a dict of headers to send
+        Any other arguments are passed on to requests.'''
+        return self.__get_session().request(method, url,
+                                            auth = auth,
+                                            headers = headers,
+                                            timeout = self.timeout,
+                                            **kwargs)
+
+class RateLimiter(object):
+    '''A thread-safe token bucket limiting how fast requests are sent.
+
+    rate is the number of requests allowed per second, and burst the number
+    that may be sent at once after a quiet spell. If rate is None there is no
+    limit until the API says otherwise.
+
+    The limiter adapts to the rate limit headers of each response, spreading
+    the requests remaining over the time left until the limit resets. Share
+    one between clients that use the same account.'''
+    def __init__(self, rate=None, burst=10):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._stamp = time.time()
+        self._resume = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Wait until a request may be sent.'''
+        while True:
+            with self._lock:
+                now = time.time()
+                wait = self._resume - now
+                if (wait <= 0):
+                    if self.rate is None:
+                        return
+
+                    refill = (now - self._stamp) * self.rate
+                    self._tokens = min(self.burst, self._tokens + refill)
+                    self._stamp = now
+                    if (self._tokens >= 1):
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def update(self, headers):
+        '''Adapt to the rate limit headers of a response.'''
+        try:
+            remaining = int(headers["X-RateLimit-Remaining"])
+            reset = int(headers["X-RateLimit-Reset"])
+        except (KeyError, TypeError, ValueError):
+            return
+
+        with self._lock:
+            if (remaining > 0):
+                self.rate = remaining / max(reset - time.time(), 1.0)
+            else:
+                self._resume = max(self._resume, reset)
+
+    def pause(self, seconds=None):
+        '''Stop all requests for a while, e.g. after being told to by a 429.
+        seconds defaults to one.'''
+        try:
+            seconds = float(seconds)
+        except (TypeError, ValueError):
+            seconds = 1.0
+
+        with self._lock:
+            self._resume = max(self._resume, time.time() + seconds)
+
+class SharedRateLimiter(RateLimiter):
+    '''A RateLimiter whose budget is shared by every process forked after it
+    is created, e.g. the workers of run_sharded.'''
+    def __init__(self, rate=None, burst=10):
+        # rate (or -1 for None), tokens, stamp and resume, in shared memory.
+        self.__state = multiprocessing.Array('d', 4, lock=False)
+        RateLimiter.__init__(self, rate, burst)
+        self._lock = multiprocessing.Lock()
+
+    def __shared(index):
+        def get(self):
+            return self.__state[index]
+
+        def set(self, value):
+            self.__state[index] = value
+        return property(get, set)
+
+    _tokens = __shared(1)
+    _stamp = __shared(2)
+    _resume = __shared(3)
+    del __shared
+
+    @property
+    def rate(self):
+        rate = self.__state[0]
+        return None if (rate < 0) else rate
+
+    @rate.setter
+    def rate(self, value):
+        self.__state[0] = -1 if value is None else value
+
+# Requests that can be safely sent twice, and responses worth retrying.
+_IDEMPOTENT_METHODS = ('get', 'put', 'delete')
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def _endpoint_template(url):
+    '''Replace the names and ids in a url with {id}, so that e.g.
+    /domains/example.com/records/1 becomes /domains/{id}/records/{id}.'''
+    segments = url.partition('?')[0].split('/')
+    for index in range(2, len(segments), 2):
+        if segments[index]:
+            segments[index] = '{id}'
+    return '/'.join(segments)
+
+def _new_sample(method, url):
+    '''An empty metrics sample for a request, as described for
+    MetricsCollector.'''
+    return {"method": method.upper(), "endpoint": _endpoint_template(url),
+            "status": None, "size": 0, "error": None,
+            "request_time": 0.0, "parse_time": 0.0}
+
+class MetricsCollector(object):
+    '''Collects request metrics in memory, per method and endpoint.
+
+    Give one to a client as metrics. The client calls observe once per
+    request with a sample dict of:
+        method        e.g. "GET"
+        endpoint      the url with names and ids replaced, e.g.
+                      "/domains/{id}/records/"
+        status        the HTTP status, or None if no response was received
+        size          the size of the response body in bytes
+        request_time  seconds from sending the request until the response
+                      was read, including connecting, retries and waiting on
+                      the rate limiter
+        parse_time    seconds spent parsing the response
+        error         the exception raised, or None
+    Anything else with an observe method taking a sample can be used instead,
+    e.g. to forward samples to a tracing system.'''
+
+    # Upper bounds of the latency histogram buckets, in seconds.
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+               float('inf'))
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__endpoints = {}
+
+    def observe(self, sample):
+        key = sample["method"] + ' ' + sample["endpoint"]
+        with self.__lock:
+            stats = self.__endpoints.get(key)
+            if (stats is None):
+                stats = self.__endpoints[key] = {
+                    "count": 0,
+                    "errors": 0,
+                    "bytes": 0,
+                    "statuses": {},
+                    "request_time": [0] * len(self.buckets),
+                    "parse_time": [0] * len(self.buckets)}
+
+            stats["count"] += 1
+            stats["bytes"] += sample["size"]
+            if (sample["error"] is not None):
+                stats["errors"] += 1
+            status = sample["status"]
+            stats["statuses"][status] = stats["statuses"].get(status, 0) + 1
+            for name in ("request_time", "parse_time"):
+                histogram = stats[name]
+                histogram[bisect.bisect_left(self.buckets, sample[name])] += 1
+
+    def stats(self):
+        '''Get a snapshot of the metrics so far.
+
+        Returns a dict keyed by method and endpoint, e.g.
+        "GET /domains/{id}/records/". Each value is a dict of the request
+        count, error count, total response bytes, a count per status, and for
+        request_time and parse_time the p50, p90 and p99 in seconds. These are
+        the upper bound of the histogram bucket the percentile falls in.'''
+        with self.__lock:
+            snapshot = {}
+            for key, stats in self.__endpoints.items():
+                snapshot[key] = {"count": stats["count"],
+                                 "errors": stats["errors"],
+                                 "bytes": stats["bytes"],
+                                 "statuses": dict(stats["statuses"])}
+                for name in ("request_time", "parse_time"):
+                    snapshot[key][name] = dict(
+                        (label, self.__percentile(stats[name], fraction))
+                        for label, fraction in (("p50", 0.5),
+                                                ("p90", 0.9),
+                                                ("p99", 0.99)))
+            return snapshot
+
+    def reset(self):
+        '''Forget everything collected so far.'''
+        with self.__lock:
+            self.__endpoints.clear()
+
+    def __percentile(self, histogram, fraction):
+        wanted = fraction * sum(histogram)
+        seen = 0
+        for bound, count in zip(self.buckets, histogram):
+            seen += count
+            if (seen >= wanted):
+                return bound
+        return None
+
+class CircuitOpenError(Exception):
+    '''Raised instead of sending a request to an endpoint that has been
+    failing, until the CircuitBreaker lets requests through again.'''
+
+class CircuitBreaker(object):
+    '''Stops requests being sent to an endpoint that keeps failing, so that
+    callers fail fast instead of each waiting on it to time out.
+
+    After failures failures in a row, the circuit for that endpoint opens and
+    requests to it raise CircuitOpenError. After reset_after seconds one
+    request is let through as a trial: if it succeeds the circuit closes,
+    otherwise it stays open for another reset_after seconds.
+
+    Endpoints are methods and urls with names and ids replaced, as for
+    MetricsCollector. Connection errors, timeouts, 429s and 5xx responses
+    count as failures. A breaker is thread-safe and may be shared between
+    clients.'''
+    def __init__(self, failures=5, reset_after=30):
+        self.failures = failures
+        self.reset_after = reset_after
+        self.__lock = threading.Lock()
+        # endpoint: [failures in a row, time the circuit opened or None]
+        self.__circuits = {}
+
+    def allow(self, endpoint):
+        '''Whether a request to endpoint may be sent now.'''
+        with self.__lock:
+            circuit = self.__circuits.get(endpoint)
+            if ((circuit is None) or (circuit[1] is None)):
+                return True
+            if (time.time() - circuit[1] < self.reset_after):
+                return False
+            # Let this one through, and hold the rest back until it's done.
+            circuit[1] = time.time()
+            return True
+
+    def record(self, endpoint, success):
+        '''Record the outcome of a request to endpoint.'''
+        with self.__lock:
+            circuit = self.__circuits.setdefault(endpoint, [0, None])
+            if success:
+                circuit[:] = [0, None]
+                return
+            circuit[0] += 1
+            if (circuit[0] >= self.failures):
+                circuit[1] = time.time()
+
+    def is_open(self, endpoint):
+        '''Whether requests to endpoint are currently being refused.'''
+        with self.__lock:
+            circuit = self.__circuits.get(endpoint)
+            return ((circuit is not None) and (circuit[1] is not None) and
+                    (time.time() - circuit[1] < self.reset_after))
+
+class _LatencyTracker(object):
+    '''Keeps the most recent request times per endpoint, to decide how long
+    to wait before hedging a request.'''
+    def __init__(self, window=200, min_samples=20, fraction=0.95):
+        self.window = window
+        self.min_samples = min_samples
+        self.fraction = fraction
+        self.__lock = threading.Lock()
+        self.__samples = {}
+
+    def observe(self, endpoint, seconds):
+        with self.__lock:
+            samples = self.__samples.setdefault(endpoint, [])
+            samples.append(seconds)
+            if (len(samples) > self.window):
+                del samples[0]
+
+    def delay(self, endpoint):
+        '''The given percentile of recent request times, or None if there
+        aren't enough to go on yet.'''
+        with self.__lock:
+            samples = sorted(self.__samples.get(endpoint, ()))
+        if (len(samples) < self.min_samples):
+            return None
+        return samples[min(len(samples) - 1,
+                           int(self.fraction * len(samples)))]
+
+class _Resource(object):
+    '''Base class for the typed results returned when a client is created
+    with typed=True.
+
+    Fields are kept in __slots__ rather than a dict, which makes them much
+    smaller and faster to read than the parsed JSON. Fields the class doesn't
+    know about are kept in extra, which is None if there are none.
+    Timestamps are kept as the strings the API returns, and only parsed into
+    datetimes by created and updated when asked for.'''
+    __slots__ = ('extra',)
+
+    # The key the API wraps objects of this type in, and the fields that can
+    # be sent back to it when creating or updating one.
+    _envelope = None
+    _payload_fields = ()
+
+    @classmethod
+    def from_api(cls, data):
+        '''Build an object from a parsed API response, with or without the
+        envelope it is wrapped in.'''
+        if ((len(data) == 1) and (cls._envelope in data)):
+            data = data[cls._envelope]
+
+        obj = cls.__new__(cls)
+        extra = dict(data)
+        for name in cls.__slots__:
+            setattr(obj, name, extra.pop(name, None))
+        obj.extra = extra or None
+        return obj
+
+    def to_payload(self):
+        '''Convert back to the payload the API expects when creating or
+        updating an object of this type.'''
+        fields = {}
+        for name in self._payload_fields:
+            value = getattr(self, name)
+            if value not in (None, ""):
+                fields[name] = value
+        return {self._envelope: fields}
+
+    @property
+    def created(self):
+        return _parse_timestamp(self.created_at)
+
+    @property
+    def updated(self):
+        return _parse_timestamp(self.updated_at)
+
+    def __eq__(self, other):
+        return ((type(self) is type(other)) and
+                all(getattr(self, name) == getattr(other, name)
+                    for name in self.__slots__))
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__,
+                            getattr(self, 'name', None) or self.id)
+
+def _parse_timestamp(value):
+    if not value:
+        return None
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+
+class Record(_Resource):
+    __slots__ = ('id', 'domain_id', 'name', 'record_type', 'content', 'ttl',
+                 'prio', 'created_at', 'updated_at')
+    _envelope = 'record'
+    _payload_fields = ('name', 'record_type', 'content', 'ttl', 'prio')
+
+class Domain(_Resource):
+    __slots__ = ('id', 'user_id', 'registrant_id', 'name',
+                 'name_server_status', 'registration_status', 'expires_at',
+                 'created_at', 'updated_at')
+    _envelope = 'domain'
+    _payload_fields = ('name',)
+
+class Contact(_Resource):
+    __slots__ = ('id', 'user_id', 'label', 'first_name', 'last_name',
+                 'job_title', 'organization_name', 'email_address', 'phone',
+                 'phone_ext', 'fax', 'address1', 'address2', 'city',
+                 'state_province', 'postal_code', 'country', 'created_at',
+                 'updated_at')
+    _envelope = 'contact'
+    _payload_fields = ('label', 'first_name', 'last_name', 'job_title',
+                       'organization_name', 'email_address', 'phone',
+                       'phone_ext', 'fax', 'address1', 'address2', 'city',
+                       'state_province', 'postal_code', 'country')
+
+class Template(_Resource):
+    __slots__ = ('id', 'name', 'short_name', 'description', 'created_at',
+                 'updated_at')
+    _envelope = 'dns_template'
+    _payload_fields = ('name', 'short_name', 'description')
+
+class Service(_Resource):
+    __slots__ = ('id', 'name', 'short_name', 'description', 'created_at',
+                 'updated_at')
+    _envelope = 'service'
+    _payload_fields = ('name', 'short_name', 'description')
 
 class DNSimple(object):
-    def __init__(self, uname, pwd):
-        self.__endpoint = 'https://dnsimple.com'
+    def __init__(self, uname, pwd, cache=None, conditional_get=False,
+                 limiter=None, retries=3, backoff=0.5, typed=False,
+                 metrics=None, endpoint='https://dnsimple.com',
+                 disk_cache=None, transport=None, availability_ttl=30,
+                 hedge=False, breaker=None):
+        '''cache may be a ResponseCache. If given, GET responses are served
+        from it and writes through this client invalidate it. It may be
+        shared with clients for other accounts. A write to a domain by name
+        also invalidates responses fetched using its id, and the other way
+        round, once a response has shown which id goes with which name.
+
+        If conditional_get is true, the ETag and Last-Modified of each GET
+        response are remembered, and the next GET of the same URL only
+        downloads and parses the response again if it has changed. Each
+        caller still gets a result of its own to change, unless cache is
+        given, in which case results are shared as described there.
+
+        limiter may be a RateLimiter to share with other clients. By default
+        each client has its own.
+        GET, PUT and DELETE requests that fail with a connection error, a 429
+        or a 5xx are retried up to retries times, waiting a random time of up
+        to backoff seconds, doubling with each attempt. POST requests, which
+        register, renew and purchase things, are never retried.
+
+        If typed is true, the get_ and iter_ methods for domains, records,
+        contacts, templates and services return Domain, Record, Contact,
+        Template and Service objects instead of dicts.
+
+        metrics may be a MetricsCollector, or anything else with an
+        observe(sample) method, to be told about every request made.
+
+        endpoint is the base URL of the API, which can be changed to point the
+        client at a test server.
+
+        disk_cache may be a DiskCache. If given, responses for services,
+        templates and extended attributes, which rarely change, are kept in
+        it and shared with every other process using the same file.
+
+        transport may be a Transport to share its connections with other
+        clients, e.g. one client per account. By default each client has its
+        own.
+
+        check_domains remembers each answer for availability_ttl seconds.
+
+        If hedge is true, a GET that takes longer than 95% of recent GETs to
+        the same endpoint is sent a second time, and whichever response
+        arrives first is used.
+
+        breaker may be a CircuitBreaker. If given, requests to endpoints that
+        keep failing raise CircuitOpenError straight away, or for GETs,
+        return the last response cached, even if it has expired.'''
+        self.__endpoint = endpoint.rstrip('/')
         self.__authdata = (uname, pwd)
         self.__useragent = 'DNSimple Python API v0.1'
         self.__headers = {"Accept"    : "application/json",
                           "User-Agent": self.__useragent}
-        self.__session = requests.session(auth    = self.__authdata,
-                                          headers = self.__headers)
+        self.__transport = transport if transport is not None else Transport()
+        self.__cache = cache
+        self.__validators = None
+        if conditional_get:
+            self.__validators = ResponseCache(ttl=None)
+        self.__limiter = limiter if limiter is not None else RateLimiter()
+        self.__retries = retries
+        self.__backoff = backoff
+        self.__typed = typed
+        self.__metrics = metrics
+        self.__disk_cache = disk_cache
+        self.__namespace = uname + '@' + self.__endpoint
+        self.__inflight = _SingleFlight()
+        # Domain names to ids and ids to names, as far as they are known.
+        self.__domain_aliases = {}
+        self.__availability = ResponseCache(maxsize=4096,
+                                            ttl=availability_ttl)
+        self.__latencies = _LatencyTracker() if hedge else None
+        self.__breaker = breaker
+        self.__listeners = []
+        self.__listeners_lock = threading.Lock()
+
+    def __wrap(self, cls, result):
+        '''Converts a parsed response, or an iterator of them, to cls if this
+        client returns typed results.'''
+        if not self.__typed:
+            return result
+        if isinstance(result, dict):
+            return cls.from_api(result)
+        if isinstance(result, list):
+            return [cls.from_api(item) for item in result]
+        return itertools.imap(cls.from_api, result)
+
+    def __resthelper(self, method, url, data="", expect_404=False):
+        '''Handles requests, going through the caches if there are any.
 
-    def __resthelper(self, method, url, data="", expect_404=False):    
-        '''Handles requests.
-        
         url is the url for the request
         method should be a string indicating the method, e.g. 'get'
         postdata should be a python dict'''
+        if (method != 'get'):
+            try:
+                return self.__request(method, url, data, expect_404)
+            finally:
+                if (self.__cache is not None):
+                    for target in self.__domain_urls(url):
+                        self.__cache.invalidate(target, self.__namespace)
+                if (self.__disk_cache is not None):
+                    self.__disk_cache.invalidate(self.__namespace, url)
+
+        key = (self.__namespace, method, url)
+        if (self.__cache is not None):
+            result = self.__cache.get(key, _MISSING)
+            if (result is not _MISSING):
+                return result
+
+        def fetch():
+            persistent = ((self.__disk_cache is not None) and
+                          bool(_PERSISTENT_URLS.match(url)))
+            result = _MISSING
+            if persistent:
+                result = self.__disk_cache.get(self.__namespace, url,
+                                               _MISSING)
+
+            if (result is _MISSING):
+                result = self.__request(method, url, data, expect_404)
+                if persistent:
+                    self.__disk_cache.set(self.__namespace, url, result)
+
+            if (self.__cache is not None):
+                self.__cache.set(key, result)
+            return result
+
+        # Threads asking for the same thing at the same time share one
+        # request rather than each making their own.
+        try:
+            return self.__inflight.do(key, fetch)
+        except CircuitOpenError:
+            result = _MISSING
+            if (self.__cache is not None):
+                result = self.__cache.get_stale(key, _MISSING)
+            if ((result is _MISSING) and (self.__validators is not None)):
+                validator = self.__validators.get(key)
+                if validator:
+                    result = validator[2]
+            if (result is _MISSING):
+                raise
+            return result
+
+    def __learn_domains(self, url, result):
+        '''Remember which domain name goes with which id, from a response to
+        a url under /domains, so that a write through either forgets the
+        cached responses for both.'''
+        segments = url.partition('?')[0].strip('/').split('/')
+        if (segments[0] != 'domains'):
+            return
+        items = result if isinstance(result, list) else [result]
+
+        pairs = []
+        if (len(segments) <= 2):
+            # A domain, or the list of them.
+            pairs = [(item["domain"].get("name"), item["domain"].get("id"))
+                     for item in items
+                     if (isinstance(item, dict) and
+                         isinstance(item.get("domain"), dict))]
+        elif (items and isinstance(items[0], dict) and
+                                isinstance(items[0].get("record"), dict)):
+            # A record, or the list of them.
+            pairs = [(segments[1], items[0]["record"].get("domain_id"))]
+
+        for name, domain_id in pairs:
+            # A url with the id in it tells us nothing about the name.
+            if (name and domain_id and (str(domain_id) != name)):
+                self.__domain_aliases[name] = str(domain_id)
+                self.__domain_aliases[str(domain_id)] = name
+
+    def __domain_urls(self, url):
+        '''url, and if it names a domain whose id is known, or the other way
+        round, the same url using the other.'''
+        segments = url.split('/')
+        alias = None
+        if ((len(segments) > 2) and (segments[1] == 'domains')):
+            alias = self.__domain_aliases.get(segments[2])
+        if (alias is None):
+            return [url]
+        return [url, '/'.join(segments[:2] + [alias] + segments[3:])]
+
+    def __send(self, method, url, **kwargs):
+        '''Sends a request for a url below the endpoint through the circuit
+        breaker and rate limiter, retrying it if that is safe and
+        worthwhile. Returns the response.'''
+        circuit = method.upper() + ' ' + _endpoint_template(url)
+        if ((self.__breaker is not None) and
+                                        not self.__breaker.allow(circuit)):
+            raise CircuitOpenError('Not sending %s %s, as %s keeps failing.'
+                                   % (method.upper(), url, circuit))
+
         url = self.__endpoint + url
+        headers = dict(self.__headers, **kwargs.pop("headers", {}))
+        attempt = 0
+        while True:
+            self.__limiter.acquire()
+            try:
+                response = self.__transport.request(method, url,
+                                                    self.__authdata,
+                                                    headers,
+                                                    **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
+                if ((method not in _IDEMPOTENT_METHODS) or
+                                                (attempt >= self.__retries)):
+                    if (self.__breaker is not None):
+                        self.__breaker.record(circuit, False)
+                    raise
+            else:
+                self.__limiter.update(response.headers)
+                if (response.status_code == 429):
+                    self.__limiter.pause(response.headers.get("Retry-After"))
+
+                if ((method not in _IDEMPOTENT_METHODS) or
+                        (response.status_code not in _RETRY_STATUSES) or
+                        (attempt >= self.__retries)):
+                    if (self.__breaker is not None):
+                        self.__breaker.record(circuit, response.status_code
+                                                    not in _RETRY_STATUSES)
+                    return response
+
+            # Full jitter, so that many clients don't all retry at once.
+            time.sleep(random.uniform(0, self.__backoff * (2 ** attempt)))
+            attempt += 1
+
+    def __hedged_send(self, url, **kwargs):
+        '''Sends a GET and, if it takes longer than most recent GETs to the
+        same endpoint have, sends it again. Returns the first response to
+        arrive, or raises the first error if both attempts fail.'''
+        endpoint = _endpoint_template(url)
+        delay = self.__latencies.delay(endpoint)
+        answers = Queue.Queue()
+
+        def attempt():
+            started = time.time()
+            try:
+                response = self.__send('get', url, **kwargs)
+            except Exception:
+                answers.put((False, sys.exc_info()))
+            else:
+                self.__latencies.observe(endpoint, time.time() - started)
+                answers.put((True, response))
+
+        def start():
+            thread = threading.Thread(target=attempt)
+            thread.daemon = True
+            thread.start()
+
+        if (delay is None):
+            # Not enough known about this endpoint yet to say what's slow.
+            attempt()
+            sent = 1
+        else:
+            start()
+            sent = 1
+            try:
+                first = answers.get(timeout=delay)
+            except Queue.Empty:
+                start()
+                sent = 2
+            else:
+                # Back on the queue for the loop below.
+                answers.put(first)
+
+        error = None
+        for _ in range(sent):
+            success, value = answers.get()
+            if success:
+                return value
+            error = error or value
+        raise error[0], error[1], error[2]
+
+    def __stream(self, url):
+        '''Performs a GET of a list, yielding each item as soon as it has
+        been read rather than reading the whole response first.'''
+        sample = _new_sample('get', url)
+        started = time.time()
+        try:
+            request = self.__send('get', url, prefetch = False)
+            sample["status"] = request.status_code
+            request.raise_for_status()
+        except Exception, e:
+            sample["error"] = e
+            sample["request_time"] = time.time() - started
+            if (self.__metrics is not None):
+                self.__metrics.observe(sample)
+            raise
+        sample["request_time"] = time.time() - started
+        return self.__observe_stream(request, sample)
+
+    def __observe_stream(self, request, sample):
+        '''Parses a streamed response, timing reading and parsing as the
+        caller works through it, and reporting the sample once it is done.
+        '''
+        chunks = request.iter_content(_STREAM_CHUNK_SIZE)
+
+        def read():
+            while True:
+                started = time.time()
+                chunk = next(chunks, None)
+                sample["request_time"] += time.time() - started
+                if chunk is None:
+                    return
+                sample["size"] += len(chunk)
+                yield chunk
+
+        items = _iter_json_array(read())
+        try:
+            while True:
+                started = time.time()
+                reading = sample["request_time"]
+                item = next(items, _MISSING)
+                # Time spent waiting on the network is already counted.
+                sample["parse_time"] += ((time.time() - started) -
+                                         (sample["request_time"] - reading))
+                if (item is _MISSING):
+                    return
+                yield item
+        except Exception, e:
+            sample["error"] = e
+            raise
+        finally:
+            if (self.__metrics is not None):
+                self.__metrics.observe(sample)
+
+    def __list(self, url, per_page=None):
+        '''Iterates over a list, either streaming it or, if per_page is given,
+        a page at a time.'''
+        if per_page:
+            return self.__paginate(url, per_page)
+        return self.__stream(url)
+
+    def __paginate(self, url, per_page):
+        '''Performs GETs of a list a page at a time, yielding each item. The
+        next page is fetched in the background while the caller works through
+        the current one.'''
+        def fetch(page):
+            return self.__resthelper('get', '%s?page=%d&per_page=%d' %
+                                            (url, page, per_page))
+
+        pool = ThreadPool(1)
+        try:
+            pending = pool.apply_async(fetch, (1,))
+            first = None
+            page = 1
+            while pending:
+                items = pending.get()
+
+                # A full page means there may be more. Anything else, or the
+                # first page again if pagination was ignored, is the last.
+                if (page > 1) and items and (items[0] == first):
+                    return
+                pending = None
+                if (len(items) == per_page):
+                    pending = pool.apply_async(fetch, (page + 1,))
+                if (page == 1) and items:
+                    first = items[0]
+
+                for item in items:
+                    yield item
+                page += 1
+        finally:
+            pool.terminate()
+
+    def __request(self, method, url, data="", expect_404=False):    
+        '''Performs a request against the API and parses the response.'''
+        key = (self.__namespace, method, url)
+        kwargs = {}
+        validator = None
        
         # No assumptions. Check the method given.
         if (method == 'get'):
-            request = self.__session.get(url)
-            
+            extra_header = {}
+            if (self.__validators is not None):
+                validator = self.__validators.get(key)
+
+            if validator:
+                etag, modified, result = validator
+                if etag:
+                    extra_header["If-None-Match"] = etag
+                if modified:
+                    extra_header["If-Modified-Since"] = modified
+            kwargs["headers"] = extra_header
+        
+        elif ((method in ("post", "put")) and data):
+            # Refuse to post or put without data.
+            kwargs["headers"] = {"Content-Type": "application/json"}
+            kwargs["data"] = _json_dumps(data)
+        
+        elif (method != "delete"):
+            raise Exception('Could not find valid method to perform.')
+
+        sample = _new_sample(method, url)
+        started = time.time()
+        try:
+            if ((method == 'get') and (self.__latencies is not None)):
+                request = self.__hedged_send(url, **kwargs)
+            else:
+                request = self.__send(method, url, **kwargs)
+            sample["status"] = request.status_code
+            sample["size"] = len(request.content)
+            received = time.time()
+            sample["request_time"] = received - started
+
+            # Nothing has changed since we last asked, so reuse what we
+            # parsed then.
+            if (validator and (request.status_code == 304)):
+                return self.__unshared(result)
+
             # For reasons totally opaque to me, some methods of the DNSimple
             # API legitimately return a 404. We don't want to die when that
-            # happens, so be careful.
+            # happens, so be careful. Posts and puts have never checked.
             if (expect_404 and (request.status_code == 404)): pass
-            else:
+            elif (method in ('get', 'delete')):
                 request.raise_for_status()
-            return json.loads(request.text)
-        
-        elif ((method == "post") and data):
-            # Refuse to post without data.
-            extra_header = {"Content-Type": "application/json"}
-            postdata = json.dumps(data)
-            request = self.__session.post(url,
-                                          data = postdata, 
-                                          headers = extra_header)
-            return json.loads(request.text)
-       
-        elif ((method == "put") and data):
-            # Refuse to put without data.
-            extra_header = {"Content-Type": "application/json"}
-            postdata = json.dumps(data)
-            request = self.__session.put(url,
-                                         data = postdata,
-                                         headers = extra_header)
-            return json.loads(request.text)
-        
-        elif (method == "delete"):
-            request = self.__session.delete(url)
-            request.raise_for_status()
-            return json.loads(request.text)
-        
-        else:
-            raise Exception('Could not find valid method to perform.')
+
+            # Parse the bytes as they arrived. Going through request.text
+            # would guess the encoding and make a decoded copy first.
+            result = _json_loads(request.content)
+            sample["parse_time"] = time.time() - received
+        except Exception, e:
+            sample["error"] = e
+            raise
+        finally:
+            if (self.__metrics is not None):
+                self.__metrics.observe(sample)
+
+        if (self.__cache is not None):
+            self.__learn_domains(url, result)
+
+        if (method == 'get'):
+            etag = request.headers.get("ETag")
+            modified = request.headers.get("Last-Modified")
+            if ((self.__validators is not None) and (etag or modified)):
+                self.__validators.set(key, (etag, modified,
+                                            self.__unshared(result)))
+        return result
+
+    def __unshared(self, result):
+        '''A copy of a remembered result to hand out, so that callers
+        changing theirs can't change anyone else's. With a ResponseCache,
+        results are shared anyway.'''
+        if (self.__cache is not None):
+            return result
+        return copy.deepcopy(result)
 
     ###########################################################################
     # DOMAINS                                                                 #
@@ -71,7 +1517,19 @@ class DNSimple(object):
         
         domain may be absent, blank, the name of a domain or the id of a
         domain'''
-        return self.__resthelper('get', '/domains/' + domain)
+        return self.__wrap(Domain,
+                           self.__resthelper('get', '/domains/' + domain))
+
+    def iter_domains(self, per_page=None):
+        '''Iterate over all domains in your account.
+
+        The items are the same as those in the list returned by get_domain,
+        but are parsed one at a time as the response arrives, so memory use
+        does not grow with the number of domains.
+
+        If per_page is given, domains are instead fetched per_page at a time,
+        and only as they are needed.'''
+        return self.__wrap(Domain, self.__list('/domains/', per_page))
 
     def create_domain(self, domainname):
         '''Create a single domain in DNSimple in your account.'''
@@ -84,6 +1542,37 @@ class DNSimple(object):
                                  '/domains/' + domainname + '/check',
                                  expect_404=True)
 
+    def check_domains(self, names, max_workers=10):
+        '''Check whether each of the given domains is available for
+        registration, up to max_workers at once.
+
+        Yields (name, success, value) as each check finishes, in no
+        particular order, where value is what check_domain returns if success
+        is True, or the exception raised if it is False. Names come back
+        normalised, stripped of whitespace and lower-cased, and are checked
+        once each, however many times they are given. Answers are
+        remembered for a short while, so checking a name again soon after
+        costs no request.'''
+        pending = []
+        for name in OrderedDict.fromkeys(name.strip().lower()
+                                         for name in names):
+            answer = self.__availability.get(('check', name), _MISSING)
+            if answer is _MISSING:
+                pending.append(name)
+            else:
+                yield name, True, answer
+
+        def check(name):
+            try:
+                answer = self.check_domain(name)
+            except Exception, e:
+                return name, False, e
+            self.__availability.set(('check', name), answer)
+            return name, True, answer
+
+        for result in _iter_concurrently(check, pending, max_workers):
+            yield result
+
     def register_domain(self,
                         domainname,
                         registrant_id="",
@@ -217,7 +1706,8 @@ class DNSimple(object):
 
     def get_services(self, serviceid=""):
         '''Describe all services or a particular service.'''
-        return self.__resthelper('get', '/services/' + serviceid)
+        return self.__wrap(Service,
+                           self.__resthelper('get', '/services/' + serviceid))
 
     def get_applied_services(self, domain):
         '''List services already applied to a domain.
@@ -264,8 +1754,23 @@ class DNSimple(object):
         
         domain must be the domain name or id.
         record_id must be absent, the emptry string or the record id.'''
-        return self.__resthelper('get',
-                                 '/domains/' + domain + '/records/' + record_id)
+        return self.__wrap(Record,
+                           self.__resthelper('get', ('/domains/' + domain +
+                                                     '/records/' + record_id)))
+
+    def iter_records(self, domain, per_page=None):
+        '''Iterate over all records associated with a given domain.
+
+        domain must be the domain name or id.
+        The items are the same as those in the list returned by get_record,
+        but are parsed one at a time as the response arrives, so memory use
+        does not grow with the size of the zone.
+
+        If per_page is given, records are instead fetched per_page at a time,
+        and only as they are needed.'''
+        return self.__wrap(Record,
+                           self.__list('/domains/' + domain + '/records/',
+                                       per_page))
 
     def create_record(self,
                       domain,
@@ -290,9 +1795,13 @@ class DNSimple(object):
         if record_prio:
             (postdata["record"])["prio"] = record_prio
 
-        return self.__resthelper('post',
-                                 '/domains/' + domain + '/records',
-                                 data = postdata)
+        result = self.__resthelper('post',
+                                   '/domains/' + domain + '/records',
+                                   data = postdata)
+        if ("record" in result):
+            self.__notify('create', domain, result["record"]["id"],
+                          result["record"])
+        return result
 
     def update_record(self,
                       domain,
@@ -320,17 +1829,401 @@ class DNSimple(object):
         if record_prio:
             (postdata["record"])["prio"] = record_prio
 
-        return self.__resthelper('put',
-                                 '/domains/' + domain + '/records/' + record_id,
-                                 data = postdata)
+        result = self.__resthelper('put',
+                                   '/domains/' + domain + '/records/' +
+                                   record_id,
+                                   data = postdata)
+        if ("record" in result):
+            self.__notify('update', domain, record_id, result["record"])
+        return result
 
     def delete_record(self, domain, record_id):
         '''Delete the record with the given id for the given domain.
         
         domain must be the domain name or id.
         record_id must be the record id.'''
-        return self.__resthelper('delete',
-                                 '/domains/' + domain + '/records/' + record_id)
+        result = self.__resthelper('delete',
+                                   '/domains/' + domain + '/records/' +
+                                   record_id)
+        self.__notify('delete', domain, record_id, None)
+        return result
+
+    def buffered(self, **options):
+        '''Get a WriteBuffer for this client, which queues record changes and
+        sends them in merged batches. See WriteBuffer for the options.'''
+        return WriteBuffer(self, **options)
+
+    def add_record_listener(self, listener):
+        '''Call listener after every record created, updated or deleted
+        through this client.
+
+        listener is called as listener(action, domain, record_id, record),
+        where action is 'create', 'update' or 'delete', domain is as passed to
+        the method, and record is the record dict from the response, or None
+        for deletes. It is called on the thread that made the change, and
+        should not raise.'''
+        with self.__listeners_lock:
+            self.__listeners = self.__listeners + [listener]
+
+    def remove_record_listener(self, listener):
+        '''Stop calling a listener added with add_record_listener.'''
+        with self.__listeners_lock:
+            self.__listeners = [l for l in self.__listeners
+                                if l is not listener]
+
+    def __notify(self, action, domain, record_id, record):
+        for listener in self.__listeners:
+            listener(action, domain, record_id, record)
+
+    ###########################################################################
+    # BULK RECORDS                                                            #
+    ###########################################################################
+
+    # Each of these returns one (success, value) tuple per item, in the same
+    # order as the items were given. value is the parsed response if success
+    # is True, or the exception that was raised if it is False. A create or
+    # update the API rejects, e.g. with a 422, counts as a failure. One
+    # failure never stops the rest of the batch.
+
+    def create_records(self, domain, records, max_workers=10):
+        '''Create many records for the given domain concurrently.
+
+        domain must be the domain name or id.
+        records must be a list of dicts, with keys as returned by get_record:
+        "name", "record_type" and "content" are required, "ttl" and "prio" are
+        optional.'''
+        def create(record):
+            return _expect_record(self.create_record(domain,
+                                                     record["name"],
+                                                     record["record_type"],
+                                                     record["content"],
+                                                     record.get("ttl", ""),
+                                                     record.get("prio", "")))
+
+        return _run_concurrently(create, records, max_workers)
+
+    def update_records(self, domain, records, max_workers=10):
+        '''Update many records for the given domain concurrently.
+
+        domain must be the domain name or id.
+        records must be a list of dicts, each with the "id" of the record to
+        update and any of "name", "content", "ttl" and "prio".
+        Updates to the same record are applied in the order given.'''
+        def update(record):
+            return _expect_record(self.update_record(domain,
+                                                     str(record["id"]),
+                                                     record.get("name", ""),
+                                                     record.get("content", ""),
+                                                     record.get("ttl", ""),
+                                                     record.get("prio", "")))
+
+        return _run_concurrently(update, records, max_workers,
+                                 key=lambda record: record["id"])
+
+    def delete_records(self, domain, record_ids, max_workers=10):
+        '''Delete many records from the given domain concurrently.
+
+        domain must be the domain name or id.
+        record_ids must be a list of record ids.'''
+        def delete(record_id):
+            return self.delete_record(domain, str(record_id))
+
+        return _run_concurrently(delete, record_ids, max_workers)
+
+    def sync_zone(self, domain, desired_records, dry_run=False,
+                  max_workers=10):
+        '''Make the records of the given domain match desired_records, using
+        as few API calls as possible.
+
+        domain must be the domain name or id.
+        desired_records must be a list of dicts, in the form accepted by
+        create_records. Records that already exist are left alone, and
+        records whose content, TTL or prio changed are updated in place.
+        Records that aren't desired are deleted first, then updates are
+        made, then new records created. The SOA and NS records of the domain
+        itself are never deleted unless desired_records contains apex
+        records of that type.
+
+        Returns the plan, a dict with "create", "update" and "delete" lists in
+        the form accepted by create_records, update_records and
+        delete_records. If dry_run is true nothing is changed. Otherwise the
+        plan is applied and each list holds the results of its batch instead.
+        '''
+        existing = [r["record"] for r in
+                    self.__resthelper('get',
+                                      '/domains/' + domain + '/records/')]
+        plan = _diff_records(existing, desired_records)
+
+        if dry_run:
+            return plan
+
+        # Delete first, so that new records can't clash with old ones (e.g. a
+        # CNAME replacing an A record).
+        return {"delete": self.delete_records(domain, plan["delete"],
+                                              max_workers),
+                "update": self.update_records(domain, plan["update"],
+                                              max_workers),
+                "create": self.create_records(domain, plan["create"],
+                                              max_workers)}
+
+    ###########################################################################
+    # ZONE FILES                                                              #
+    ###########################################################################
+
+    def export_zone(self, domain, fileobj, default_ttl=3600):
+        '''Write the records of the given domain to fileobj as a BIND zone
+        file.
+
+        domain must be the domain name.
+        Records are written as they are read from the API, so memory use does
+        not grow with the size of the zone. default_ttl is used for records
+        without a TTL.'''
+        fileobj.write('$ORIGIN %s.\n' % domain.rstrip('.'))
+        for item in self.__stream('/domains/' + domain + '/records/'):
+            fileobj.write(_zone_file_line(item["record"], default_ttl))
+
+    def import_zone(self, domain, fileobj, batch_size=500, max_workers=10):
+        '''Create records for the given domain from a BIND zone file.
+
+        domain must be the domain name.
+        The file is read a line at a time and records are created in batches
+        of batch_size, max_workers at a time. Records that already exist,
+        with the same name, type and content, are skipped, so importing the
+        same file twice changes nothing. SOA and NS records for the domain
+        itself are skipped, as DNSimple manages those.
+
+        Returns a dict of the number of records "created" and "unchanged",
+        and a list of "failed" (record, error) pairs.'''
+        existing = set()
+        for item in self.__stream('/domains/' + domain + '/records/'):
+            record = item["record"]
+            existing.add((record["name"], record["record_type"],
+                          record["content"]))
+
+        summary = {"created": 0, "unchanged": 0, "failed": []}
+
+        def create(batch):
+            for record, (success, value) in zip(batch, self.create_records(
+                                                domain, batch, max_workers)):
+                if success:
+                    summary["created"] += 1
+                else:
+                    summary["failed"].append((record, value))
+
+        batch = []
+        for record in _iter_zone_records(fileobj, domain):
+            if ((not record["name"]) and
+                        (record["record_type"] in SYSTEM_RECORD_TYPES)):
+                continue
+
+            key = (record["name"], record["record_type"], record["content"])
+            if (key in existing):
+                summary["unchanged"] += 1
+                continue
+            existing.add(key)
+
+            batch.append(record)
+            if (len(batch) >= batch_size):
+                create(batch)
+                batch = []
+
+        if batch:
+            create(batch)
+        return summary
+
+    ###########################################################################
+    # INVENTORY                                                               #
+    ###########################################################################
+
+    def inventory(self, max_workers=10, checkpoint=None):
+        '''Take a snapshot of every domain in your account.
+
+        For each domain, fetches its records, applied services, members and
+        SSL certificates, working on up to max_workers domains at once.
+        Yields (domain name, success, value) as each domain is finished, in no
+        particular order. value is a dict with "domain", "records",
+        "applied_services", "members" and "certificates" if success is True,
+        or the exception raised if it is False.
+
+        checkpoint may be the path of a file recording which domains are
+        done. A domain is recorded once it succeeded and the caller has asked
+        for the next one. Domains already recorded there are skipped, so an
+        interrupted inventory can be resumed by passing the same path again.
+        '''
+        done = set()
+        if (checkpoint and os.path.exists(checkpoint)):
+            with open(checkpoint) as finished:
+                done = set(line.strip() for line in finished)
+
+        domains = [item["domain"] for item in self.__stream('/domains/')
+                   if item["domain"]["name"] not in done]
+
+        def snapshot(domain):
+            name = domain["name"]
+            try:
+                return name, True, {
+                    "domain": self.__wrap(Domain, {"domain": domain}),
+                    "records": self.get_record(name),
+                    "applied_services": self.get_applied_services(name),
+                    "members": self.get_domain_members(name),
+                    "certificates": self.get_ssl_certificate(name)}
+            except Exception, e:
+                return name, False, e
+
+        if not domains:
+            return
+
+        finished = open(checkpoint, 'a') if checkpoint else None
+        try:
+            for name, success, value in _iter_concurrently(snapshot, domains,
+                                                           max_workers):
+                yield name, success, value
+                if (finished and success):
+                    finished.write(name + '\n')
+                    finished.flush()
+        finally:
+            if finished:
+                finished.close()
+
+    ###########################################################################
+    # WATCHING                                                                #
+    ###########################################################################
+
+    def watch(self, domains, interval=60, max_workers=10, callback=None):
+        '''Watch the records of the given domains for changes, however they
+        are made.
+
+        Each domain's records are fetched every interval seconds, with the
+        domains spread evenly over the interval rather than all fetched at
+        once, and no more than max_workers fetched at the same time. The
+        first fetch of each domain is just remembered. After that, an event
+        is produced for each record added, removed or changed. Events are
+        dicts of:
+            event     "added", "removed", "changed", or "error" if the
+                      records couldn't be fetched
+            domain    the domain, as given
+            record    the record as it is now, or as it was if removed
+            previous  the record as it was before, if changed
+            error     the exception raised, if event is "error"
+
+        Zones whose response hasn't changed, by ETag or by hash of the
+        response body, aren't parsed or compared again.
+
+        If callback is None, returns an iterator of events, which watches for
+        as long as it is iterated over. Otherwise callback is called with each
+        event from a background thread, and a threading.Event is returned;
+        set it to stop watching.'''
+        domains = list(OrderedDict.fromkeys(domains))
+        if callback is None:
+            return self.__watch(domains, interval, max_workers, None)
+
+        stopped = threading.Event()
+
+        def run():
+            for event in self.__watch(domains, interval, max_workers,
+                                      stopped):
+                callback(event)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return stopped
+
+    def __watch(self, domains, interval, max_workers, stopped):
+        # domain: (ETag, hash of the response body, records by id)
+        zones = {}
+
+        def poll(domain):
+            try:
+                return domain, self.__poll_zone(domain, zones)
+            except Exception, e:
+                return domain, [{"event": "error", "domain": domain,
+                                 "error": e}]
+
+        if not domains:
+            return
+
+        results = Queue.Queue()
+        polling = set()
+        started = time.time()
+        schedule = [(started + index * float(interval) / len(domains), domain)
+                    for index, domain in enumerate(domains)]
+        pool = ThreadPool(min(max_workers, len(domains)))
+        try:
+            while not (stopped and stopped.is_set()):
+                while (schedule[0][0] <= time.time()):
+                    due, domain = heapq.heappop(schedule)
+                    heapq.heappush(schedule, (due + interval, domain))
+                    # A zone still being fetched from last time is skipped.
+                    if domain not in polling:
+                        polling.add(domain)
+                        pool.apply_async(poll, (domain,),
+                                         callback=results.put)
+
+                try:
+                    domain, events = results.get(
+                        timeout=max(0, schedule[0][0] - time.time()))
+                except Queue.Empty:
+                    continue
+                polling.discard(domain)
+                for event in events:
+                    yield event
+        finally:
+            pool.terminate()
+
+    def __poll_zone(self, domain, zones):
+        '''Fetch a domain's records and return a list of the events since it
+        was last fetched.'''
+        etag, digest, records = zones.get(domain, (None, None, None))
+        headers = {"If-None-Match": etag} if etag else {}
+        url = '/domains/' + domain + '/records/'
+        sample = _new_sample('get', url)
+        started = time.time()
+        try:
+            response = self.__send('get', url, headers=headers)
+            sample["status"] = response.status_code
+            sample["size"] = len(response.content)
+            received = time.time()
+            sample["request_time"] = received - started
+            if (etag and (response.status_code == 304)):
+                return []
+            response.raise_for_status()
+
+            etag = response.headers.get("ETag")
+            new_digest = hashlib.sha1(response.content).hexdigest()
+            if (new_digest == digest):
+                zones[domain] = (etag, digest, records)
+                return []
+
+            current = OrderedDict((item["record"]["id"], item["record"])
+                                  for item in _json_loads(response.content))
+            sample["parse_time"] = time.time() - received
+        except Exception, e:
+            sample["error"] = e
+            raise
+        finally:
+            if (self.__metrics is not None):
+                self.__metrics.observe(sample)
+
+        zones[domain] = (etag, new_digest, current)
+        if records is None:
+            return []
+
+        events = []
+        for record_id, record in current.items():
+            previous = records.get(record_id)
+            if previous is None:
+                events.append({"event": "added", "domain": domain,
+                               "record": self.__wrap(Record, record)})
+            elif (previous != record):
+                events.append({"event": "changed", "domain": domain,
+                               "record": self.__wrap(Record, record),
+                               "previous": self.__wrap(Record, previous)})
+        for record_id, record in records.items():
+            if record_id not in current:
+                events.append({"event": "removed", "domain": domain,
+                               "record": self.__wrap(Record, record)})
+        return events
 
     ###########################################################################
     # VANITY NAME SERVERS                                                     #
@@ -381,8 +2274,15 @@ class DNSimple(object):
         '''Get all contacts or a specific contact from the account
         
         contact_id must be absent, the empty string or the contact id.'''
-        return self.__resthelper('get',
-                                 '/contacts/' + contact_id)
+        return self.__wrap(Contact,
+                           self.__resthelper('get', '/contacts/' + contact_id))
+
+    def iter_contacts(self, per_page=None):
+        '''Iterate over all contacts in the account.
+
+        The items are the same as those in the list returned by get_contact,
+        and are handled as for iter_domains.'''
+        return self.__wrap(Contact, self.__list('/contacts/', per_page))
 
     def create_contact(self,
                        first_name,
@@ -499,8 +2399,15 @@ class DNSimple(object):
 
         template must be absent, the empty string or the template short name or
         id.'''
-        return self.__resthelper('get',
-                                 '/templates/' + template)
+        return self.__wrap(Template,
+                           self.__resthelper('get', '/templates/' + template))
+
+    def iter_templates(self, per_page=None):
+        '''Iterate over all templates in the account.
+
+        The items are the same as those in the list returned by get_template,
+        and are handled as for iter_domains.'''
+        return self.__wrap(Template, self.__list('/templates/', per_page))
 
     def create_template(self, name, short_name, description=""):
         '''Create a custom template.'''
@@ -531,6 +2438,64 @@ class DNSimple(object):
                                  ('/domains/' + domain + '/templates/' +
                                   template + '/apply'))
 
+    def rollout_template(self, template, domains, dry_run=False,
+                         max_workers=10, update=False):
+        '''Add the records of a template to many domains, skipping records
+        the domains already have.
+
+        template must be the short name or ID for the template.
+        domains must be a list of domain names or IDs.
+        The template's records are fetched once. Each domain's records are
+        then compared with them, and the template records with no record of
+        the same name, type and content are created. As with
+        apply_template_to_domain, existing records are never changed or
+        deleted.
+
+        If update is true, a record with the same name and type as a
+        missing template record, but different content, TTL or prio, is
+        instead updated to match it. Beware that this overwrites records
+        that merely share a name and type, e.g. one of several A records.
+
+        Up to max_workers domains are worked on at once.
+
+        Yields (domain, success, value) as each domain is finished, in no
+        particular order. value is the exception raised if success is False.
+        Otherwise it is the plan for the domain, as returned by sync_zone, or
+        if dry_run is false the results of applying it.'''
+        desired = [item["dns_template_record"] for item in
+                   self.__resthelper('get', ('/templates/' + template +
+                                             '/template_records/'))]
+
+        def rollout(domain):
+            try:
+                existing = [item["record"] for item in
+                            self.__resthelper('get', ('/domains/' + domain +
+                                                      '/records/'))]
+                if update:
+                    plan = _diff_records(existing, desired, delete=False)
+                    del plan["delete"]
+                else:
+                    present = set((record["name"], record["record_type"],
+                                   record["content"]) for record in existing)
+                    plan = {"update": [],
+                            "create": [record for record in desired
+                                       if (record["name"],
+                                           record["record_type"],
+                                           record["content"]) not in present]}
+                if dry_run:
+                    return domain, True, plan
+
+                # Domains are already worked on concurrently, so each one's
+                # changes are made one at a time.
+                return domain, True, {
+                    "update": self.update_records(domain, plan["update"], 1),
+                    "create": self.create_records(domain, plan["create"], 1)}
+            except Exception, e:
+                return domain, False, e
+
+        for result in _iter_concurrently(rollout, domains, max_workers):
+            yield result
+
     ###########################################################################
     # TEMPLATE RECORDS                                                        #
     ###########################################################################
@@ -695,3 +2660,499 @@ class DNSimple(object):
         return self.__resthelper('post',
                                  '/users',
                                  data = postdata)
+
+class ZoneMirror(object):
+    '''An in-memory copy of a domain's records, indexed for fast lookups.
+
+    The mirror is filled from get_record when it is created, and kept up to
+    date with every record created, updated or deleted through the same
+    client. Changes made elsewhere are picked up by refresh(), which is
+    called every refresh_interval seconds on a background thread if given.
+
+    Records are held as Record objects. All methods are thread-safe.'''
+    def __init__(self, client, domain, refresh_interval=None):
+        self.client = client
+        self.domain = domain
+        self.__lock = threading.Lock()
+        # Refreshes take turns, as they share the list of changes made
+        # meanwhile.
+        self.__refresh_lock = threading.Lock()
+        self.__by_id = {}
+        self.__by_name = {}
+        self.__by_content = {}
+        self.__domain_ids = set()
+        self.__changes = None
+        self.__stopped = threading.Event()
+
+        self.client.add_record_listener(self.__on_change)
+        self.refresh()
+
+        if refresh_interval:
+            thread = threading.Thread(target=self.__refresh_every,
+                                      args=(refresh_interval,))
+            thread.daemon = True
+            thread.start()
+
+    def find(self, name, record_type):
+        '''Get all records with the given name and type.'''
+        with self.__lock:
+            return list(self.__by_name.get((name, record_type), {}).values())
+
+    def find_content(self, content):
+        '''Get all records with the given content.'''
+        with self.__lock:
+            return list(self.__by_content.get(content, {}).values())
+
+    def get(self, record_id):
+        '''Get the record with the given id, or None.'''
+        with self.__lock:
+            return self.__by_id.get(str(record_id))
+
+    def exists(self, name, record_type, content=None):
+        '''Check for a record with the given name and type, and content if
+        given.'''
+        records = self.find(name, record_type)
+        if (content is None):
+            return bool(records)
+        return any(record.content == content for record in records)
+
+    def __len__(self):
+        return len(self.__by_id)
+
+    def __iter__(self):
+        with self.__lock:
+            return iter(list(self.__by_id.values()))
+
+    def refresh(self):
+        '''Reload every record from the API.'''
+        with self.__refresh_lock:
+            self.__refresh()
+
+    def __refresh(self):
+        with self.__lock:
+            self.__changes = []
+
+        try:
+            by_id = {}
+            for record in self.client.iter_records(self.domain):
+                if not isinstance(record, Record):
+                    record = Record.from_api(record)
+                by_id[str(record.id)] = record
+        except:
+            with self.__lock:
+                self.__changes = None
+            raise
+
+        with self.__lock:
+            changes, self.__changes = self.__changes, None
+            self.__by_id = {}
+            self.__by_name = {}
+            self.__by_content = {}
+            for record in by_id.values():
+                self.__add(record)
+
+            # Anything changed through the client while we were reading may
+            # or may not be in what we read, so apply it again.
+            for record_id, record in changes:
+                self.__apply(record_id, record)
+
+    def close(self):
+        '''Stop refreshing and stop following changes made through the
+        client.'''
+        self.__stopped.set()
+        self.client.remove_record_listener(self.__on_change)
+
+    def __refresh_every(self, interval):
+        while not self.__stopped.wait(interval):
+            try:
+                self.refresh()
+            except Exception:
+                # Keep serving what we have, and try again next time.
+                pass
+
+    def __on_change(self, action, domain, record_id, record):
+        domain = str(domain)
+        if ((domain != str(self.domain)) and
+                                        (domain not in self.__domain_ids)):
+            return
+
+        if (record is not None):
+            record = Record.from_api(record)
+
+        with self.__lock:
+            self.__apply(str(record_id), record)
+            if (self.__changes is not None):
+                self.__changes.append((str(record_id), record))
+
+    def __apply(self, record_id, record):
+        self.__remove(record_id)
+        if (record is not None):
+            self.__add(record)
+
+    def __add(self, record):
+        record_id = str(record.id)
+        self.__by_id[record_id] = record
+        self.__by_name.setdefault((record.name, record.record_type),
+                                  {})[record_id] = record
+        self.__by_content.setdefault(record.content, {})[record_id] = record
+        self.__domain_ids.add(str(record.domain_id))
+
+    def __remove(self, record_id):
+        record = self.__by_id.pop(record_id, None)
+        if (record is None):
+            return
+
+        for index, key in ((self.__by_name, (record.name, record.record_type)),
+                           (self.__by_content, record.content)):
+            del index[key][record_id]
+            if not index[key]:
+                del index[key]
+
+# What a WriteBuffer placeholder stands for while its record is being
+# created, once creating it has failed, and once it was deleted before it
+# was ever sent.
+_CREATING = object()
+_NOT_CREATED = object()
+_CANCELLED = object()
+
+class WriteBuffer(object):
+    '''Queues record changes and sends them in batches, merging changes to
+    the same record so that as few requests as possible are made.
+
+    Use create_record, update_record and delete_record just as on the
+    client. Changes are sent when flush() is called, when max_pending
+    records have changes waiting, or every flush_interval seconds on a
+    background thread, whichever comes first. Before being sent:
+        - several updates to a record become one update,
+        - updates to a record being created are folded into the create,
+        - a record created and then deleted is never sent at all,
+        - a record updated and then deleted is just deleted.
+
+    create_record returns a placeholder id, which can be used with
+    update_record and delete_record in place of the real id, before, while
+    and after the record is created. Changes made while it is being created
+    are held until it has been, and fail if it couldn't be. Once a record has
+    been deleted, whether or not it was ever created, further changes to it
+    raise ValueError.
+
+    journal, if given, is called with each change as it is queued, e.g. to
+    write it somewhere durable. on_flush, if given, is called with the
+    results of each flush. Both are dicts as described for flush().
+
+    All methods are thread-safe.'''
+    def __init__(self, client, flush_interval=1.0, max_pending=100,
+                 max_workers=10, journal=None, on_flush=None):
+        self.client = client
+        self.max_pending = max_pending
+        self.max_workers = max_workers
+        self.journal = journal
+        self.on_flush = on_flush
+        self.__lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+        self.__pending = OrderedDict()
+        # placeholder: the real id, _CREATING while the create is being
+        # sent, _NOT_CREATED if it failed, or _CANCELLED if it was deleted
+        # before being sent.
+        self.__created = {}
+        self.__placeholders = itertools.count(1)
+        self.__stopped = threading.Event()
+
+        if flush_interval:
+            thread = threading.Thread(target=self.__flush_every,
+                                      args=(flush_interval,))
+            thread.daemon = True
+            thread.start()
+
+    def create_record(self, domain, record_name, record_type, record_content,
+                      record_ttl='', record_prio=''):
+        '''Queue the creation of a record. Returns a placeholder id for it.
+        '''
+        record_id = 'pending-%d' % next(self.__placeholders)
+        fields = {"name": record_name,
+                  "record_type": record_type,
+                  "content": record_content,
+                  "ttl": record_ttl,
+                  "prio": record_prio}
+        self.__queue('create', domain, record_id, fields)
+        return record_id
+
+    def update_record(self, domain, record_id, record_name="",
+                      record_content="", record_ttl="", record_prio=""):
+        '''Queue an update to a record.'''
+        fields = {"name": record_name,
+                  "content": record_content,
+                  "ttl": record_ttl,
+                  "prio": record_prio}
+        self.__queue('update', domain, record_id,
+                     dict((k, v) for k, v in fields.items() if v))
+
+    def delete_record(self, domain, record_id):
+        '''Queue the deletion of a record.'''
+        self.__queue('delete', domain, record_id, {})
+
+    def __len__(self):
+        return len(self.__pending)
+
+    def __queue(self, action, domain, record_id, fields):
+        change = {"action": action,
+                  "domain": domain,
+                  "record_id": str(record_id),
+                  "fields": fields}
+        with self.__lock:
+            record_id = self.__created.get(change["record_id"],
+                                           change["record_id"])
+            if (record_id is _NOT_CREATED):
+                raise ValueError('Record %s could not be created.' %
+                                 change["record_id"])
+            if (record_id is _CANCELLED):
+                raise ValueError('Record %s has already been deleted.' %
+                                 change["record_id"])
+            if (record_id is _CREATING):
+                # Held under the placeholder until the real id is known.
+                record_id = change["record_id"]
+            key = (str(domain), record_id)
+            queued = self.__pending.get(key)
+
+            if (queued is None):
+                self.__pending[key] = dict(change, record_id=record_id)
+            elif (queued["action"] == 'delete'):
+                raise ValueError('Record %s is already being deleted.' %
+                                 record_id)
+            elif (action == 'update'):
+                queued["fields"].update(fields)
+            elif (queued["action"] == 'create'):
+                del self.__pending[key]
+                self.__created[record_id] = _CANCELLED
+            else:
+                self.__pending[key] = dict(change, record_id=record_id)
+
+            full = (len(self.__pending) >= self.max_pending)
+
+        if self.journal:
+            self.journal(change)
+        if full:
+            self.flush()
+
+    def flush(self):
+        '''Send every queued change now.
+
+        Returns a list of results, one per record changed. Each is a dict of
+        the "action", "domain", "record_id" and "fields" of the change, plus
+        "success" and "value", as for the bulk record methods of the client.
+        '''
+        with self.__flush_lock:
+            with self.__lock:
+                changes = list(self.__pending.values())
+                self.__pending.clear()
+                for change in changes:
+                    if (change["action"] == 'create'):
+                        self.__created[change["record_id"]] = _CREATING
+
+            if not changes:
+                return []
+
+            def send(change):
+                fields = change["fields"]
+                domain = change["domain"]
+                if (change["action"] == 'create'):
+                    return _expect_record(self.client.create_record(
+                        domain, fields["name"], fields["record_type"],
+                        fields["content"], fields["ttl"], fields["prio"]))
+                if (change["action"] == 'update'):
+                    return _expect_record(self.client.update_record(
+                        domain, change["record_id"], fields.get("name", ""),
+                        fields.get("content", ""), fields.get("ttl", ""),
+                        fields.get("prio", "")))
+                return self.client.delete_record(domain, change["record_id"])
+
+            results = []
+            for change, (success, value) in zip(changes, _run_concurrently(
+                                        send, changes, self.max_workers)):
+                results.append(dict(change, success=success, value=value))
+                if (change["action"] == 'create'):
+                    results.extend(self.__resolve(change, success, value))
+
+            if self.on_flush:
+                self.on_flush(results)
+            return results
+
+    def __resolve(self, change, success, value):
+        '''Record how the create of a placeholder went, and move changes to
+        it made meanwhile under its real id. Returns results for those
+        changes if the create failed.'''
+        placeholder = change["record_id"]
+        with self.__lock:
+            held = self.__pending.pop((str(change["domain"]), placeholder),
+                                      None)
+            if not success:
+                self.__created[placeholder] = _NOT_CREATED
+                if held is None:
+                    return []
+                return [dict(held, success=False,
+                             value=Exception('Record %s could not be '
+                                             'created.' % placeholder))]
+
+            record_id = str(value["record"]["id"])
+            self.__created[placeholder] = record_id
+            if held is not None:
+                self.__pending[(str(change["domain"]), record_id)] = \
+                                            dict(held, record_id=record_id)
+            return []
+
+    def close(self):
+        '''Stop the background thread and send anything still queued.'''
+        self.__stopped.set()
+        return self.flush()
+
+    def __flush_every(self, interval):
+        while not self.__stopped.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                # Results are reported through on_flush. Keep going.
+                pass
+
+class AsyncDNSimple(object):
+    '''Non-blocking client for the DNSimple REST API.
+
+    Exposes every method of DNSimple, but each call returns immediately with
+    an AsyncResult instead of waiting on the network. Call .get() on the
+    result to wait for the parsed response, or .ready() to poll it.
+
+    Requests are run on a pool of max_in_flight worker threads sharing a
+    single DNSimple client, and so a single keep-alive session.
+
+    Methods that return iterators, such as iter_records, inventory and
+    check_domains, are run to the end on the pool, and their result is a
+    list of everything they yielded. watch, which never ends, isn't
+    available. buffered, add_record_listener and remove_record_listener
+    make no requests, so they are called straight away and return what the
+    client's do.'''
+
+    # Never-ending, so they can't be collected on the pool.
+    _unavailable = ('watch',)
+    # Make no requests, so there is nothing to wait for.
+    _immediate = ('buffered', 'add_record_listener', 'remove_record_listener')
+
+    def __init__(self, uname, pwd, max_in_flight=10, **options):
+        '''Any other options are passed on to DNSimple.'''
+        self.__client = DNSimple(uname, pwd, **options)
+        self.__pool = ThreadPool(max_in_flight)
+
+    def __getattr__(self, name):
+        # Only wrap the public API. Everything else is a genuine error.
+        method = getattr(DNSimple, name, None)
+        if (name.startswith('_') or not callable(method) or
+                                                (name in self._unavailable)):
+            raise AttributeError(name)
+
+        method = getattr(self.__client, name)
+        if (name in self._immediate):
+            return method
+
+        def run(*args, **kwargs):
+            result = method(*args, **kwargs)
+            # Otherwise an iterator's requests would all be made later, on
+            # the caller's thread.
+            if isinstance(result, Iterator):
+                return list(result)
+            return result
+
+        def call(*args, **kwargs):
+            return self.__pool.apply_async(run, args, kwargs)
+
+        call.__name__ = name
+        call.__doc__ = method.__doc__
+        return call
+
+    def close(self):
+        '''Wait for all outstanding requests to finish and stop the workers.
+        '''
+        self.__pool.close()
+        self.__pool.join()
+
+def _picklable(error):
+    '''The error, or if it can't be sent back from a worker process, an
+    Exception describing it.'''
+    import cPickle
+    try:
+        cPickle.dumps(error, 2)
+        return error
+    except Exception:
+        return Exception('%s: %s' % (type(error).__name__, error))
+
+# The client of each run_sharded worker process.
+_shard_client = None
+
+def _init_shard(uname, pwd, options):
+    global _shard_client
+    _shard_client = DNSimple(uname, pwd, **options)
+
+def _run_shard(args):
+    indexes, operations, max_workers = args
+
+    def run(operation):
+        method, domain = operation[0], operation[1]
+        result = getattr(_shard_client, method)(domain, *operation[2:])
+        if (method in ('create_record', 'update_record')):
+            return _expect_record(result)
+        return result
+
+    results = _run_concurrently(run, operations, max_workers,
+                                key=lambda operation: operation[1])
+    return [(index, success, value if success else _picklable(value))
+            for index, (success, value) in zip(indexes, results)]
+
+def run_sharded(uname, pwd, operations, processes=None, max_workers=10,
+                rate=None, **options):
+    '''Run a large batch of domain changes across several processes, for
+    jobs big enough that one process spends its time encoding and decoding
+    JSON.
+
+    operations is a list of tuples of the name of a DNSimple method, the
+    domain, and any other arguments, e.g.
+        ('update_record', 'example.com', '123', 'www', '10.0.0.2')
+        ('create_record', 'example.com', 'mail', 'MX', 'mx.example.com')
+
+    Operations are split between processes (by default one per CPU) by
+    domain, so every operation on a domain is run by the same process, in
+    the order given. Each process has its own client, made with any other
+    options, running up to max_workers operations at once. All of them share
+    one SharedRateLimiter, with the given rate.
+
+    Returns a dict of:
+        results   a (success, value) tuple per operation, in the order
+                  given, as for the bulk record methods of DNSimple
+        failed    a list of (operation, exception) for each that failed
+    '''
+    operations = [tuple(operation) for operation in operations]
+    processes = processes or multiprocessing.cpu_count()
+
+    # Several shards per process, so that one big domain doesn't leave the
+    # other processes with nothing to do.
+    shards = [([], []) for _ in range(processes * 4)]
+    for index, operation in enumerate(operations):
+        indexes, batch = shards[hash(operation[1]) % len(shards)]
+        indexes.append(index)
+        batch.append(operation)
+
+    options["limiter"] = SharedRateLimiter(rate)
+    results = [None] * len(operations)
+    pool = multiprocessing.Pool(processes, _init_shard,
+                                (uname, pwd, options))
+    try:
+        for shard in pool.imap_unordered(_run_shard,
+                                         [(indexes, batch, max_workers)
+                                          for indexes, batch in shards
+                                          if batch]):
+            for index, success, value in shard:
+                results[index] = (success, value)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return {"results": results,
+            "failed": [(operation, value)
+                       for operation, (success, value) in zip(operations,
+                                                              results)
+                       if not success]}